@@ -0,0 +1,198 @@
+# ================================
+# 画像の配色・トーン解析（ローカル）
+# ================================
+"""
+縮小した画素配列に対して NumPy でベクトル化した k-means を回し、
+主な色とその割合、服のトーンを返す（CPUのみ・通信なし・数ミリ秒）。
+
+背景に引っ張られないように、クラスタリングの前に背景を除く。
+- 外周の画素がほぼ一色なら、その色に近い画素を背景として捨てる
+- 背景と区別できない（白い服を白い壁の前で撮った等）場合は中央部分だけを使う
+
+トーンはボットの色の選択肢（明るめな色／暗めな色／…）に合わせてあるので、
+そのまま build_keywords などのセッション値として使える。
+
+    palette = extract_palette(image.open())
+    palette.tone        # => "落ち着いた色"
+    palette.confidence  # => 0.62
+    palette.colors      # => [{"name": "紺", "hex": "#1f2a44", "ratio": 0.45}, ...]
+"""
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+Palette = namedtuple("Palette", ["colors", "tone", "confidence"])
+
+# ウィザードの色の選択肢と同じ語彙
+TONES = ["明るめな色", "暗めな色", "派手目の色", "落ち着いた色", "モノトーン"]
+
+# 色名の代表値（RGB）
+COLOR_NAMES = [
+    ("白", (245, 245, 245)),
+    ("黒", (20, 20, 20)),
+    ("グレー", (128, 128, 128)),
+    ("赤", (200, 30, 40)),
+    ("ピンク", (240, 150, 180)),
+    ("オレンジ", (240, 140, 40)),
+    ("黄色", (240, 220, 60)),
+    ("緑", (40, 140, 70)),
+    ("カーキ", (120, 120, 70)),
+    ("青", (40, 90, 200)),
+    ("紺", (30, 40, 80)),
+    ("紫", (120, 60, 150)),
+    ("茶色", (110, 70, 40)),
+    ("ベージュ", (215, 195, 160)),
+]
+_NAME_RGB = np.array([rgb for _, rgb in COLOR_NAMES], dtype=np.float32)
+
+SAMPLE_SIZE = 64
+# 外周として見る幅（画素）と、背景色とみなす距離（RGB）
+BORDER_WIDTH = 3
+BACKGROUND_DISTANCE = 48.0
+# 外周のこの割合以上が同じ色なら「一色の背景」とみなす
+UNIFORM_BORDER_RATIO = 0.6
+# 背景を除いた残りがこの割合未満なら中央部分にフォールバック
+MIN_GARMENT_RATIO = 0.05
+CENTER_CROP = 0.5
+
+
+def _load_pixels(source, size=SAMPLE_SIZE):
+    """
+    画像を size×size に縮小して (size, size, 3) の float32 配列にする。
+    JPEG はデコード時点で縮小させる（draft）ので大きな写真でも速い。
+    """
+    img = source if isinstance(source, Image.Image) else Image.open(source)
+    img.draft("RGB", (size * 2, size * 2))
+    img = img.convert("RGB").resize((size, size), Image.BILINEAR)
+    return np.asarray(img, dtype=np.float32)
+
+
+def garment_pixels(grid):
+    """
+    背景を除いた服の画素を (N, 3) で返す。
+    """
+    h, w, _ = grid.shape
+    border = np.ones((h, w), dtype=bool)
+    border[BORDER_WIDTH:h - BORDER_WIDTH, BORDER_WIDTH:w - BORDER_WIDTH] = False
+    background = np.median(grid[border], axis=0)
+    distance = np.sqrt(((grid - background) ** 2).sum(axis=2))
+
+    if (distance[border] <= BACKGROUND_DISTANCE).mean() >= UNIFORM_BORDER_RATIO:
+        foreground = distance > BACKGROUND_DISTANCE
+        if foreground.mean() >= MIN_GARMENT_RATIO:
+            return grid[foreground]
+
+    # 背景が一色でない・服と背景が同じ色: 中央部分だけを使う
+    top, left = int(h * (1 - CENTER_CROP) / 2), int(w * (1 - CENTER_CROP) / 2)
+    return grid[top:h - top, left:w - left].reshape(-1, 3)
+
+
+def kmeans(pixels, k=4, iterations=10):
+    """
+    (N, 3) の画素を k 色にまとめる。初期値は輝度順の分位点（毎回同じ結果になる）。
+    戻り値は (中心 (k, 3), 各クラスタの画素数 (k,))
+    """
+    luminance = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    order = np.argsort(luminance)
+    centers = pixels[order[(np.arange(k) * 2 + 1) * len(pixels) // (2 * k)]].copy()
+
+    labels = None
+    for _ in range(iterations):
+        distances = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        new_labels = distances.argmin(axis=1)
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack(
+            [np.bincount(labels, weights=pixels[:, c], minlength=k) for c in range(3)], axis=1
+        )
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled, None]
+
+    return centers, np.bincount(labels, minlength=k)
+
+
+# これ未満の彩度は無彩色（モノトーン）として扱う
+ACHROMATIC_SATURATION = 0.15
+
+# 無彩色の色名（明度の下限, 名前）。明るい方から順に判定する
+GRAY_NAMES = [
+    (0.88, "白"),
+    (0.65, "ライトグレー"),
+    (0.40, "グレー"),
+    (0.18, "チャコール"),
+    (0.0, "黒"),
+]
+
+
+def _saturation_value(rgb):
+    r, g, b = rgb / 255.0
+    high, low = max(r, g, b), min(r, g, b)
+    return (0.0 if high == 0 else (high - low) / high), high
+
+
+def _tone(rgb):
+    """
+    1色を HSV の彩度・明度からトーンに分類する。
+    """
+    saturation, high = _saturation_value(rgb)
+    if saturation < ACHROMATIC_SATURATION:
+        return "モノトーン"
+    if saturation >= 0.6 and high >= 0.6:
+        return "派手目の色"
+    if high >= 0.7:
+        return "明るめな色"
+    if high < 0.35:
+        return "暗めな色"
+    return "落ち着いた色"
+
+
+def _color_name(rgb):
+    """
+    無彩色は明度で白〜黒に分け、有彩色だけ代表値との距離で名前を付ける
+    （灰色が茶色・カーキ・ベージュと呼ばれないように）。
+    """
+    saturation, high = _saturation_value(rgb)
+    if saturation < ACHROMATIC_SATURATION:
+        lightness = float(rgb.mean()) / 255.0
+        return next(name for limit, name in GRAY_NAMES if lightness >= limit)
+    return COLOR_NAMES[int(((_NAME_RGB - rgb) ** 2).sum(axis=1).argmin())][0]
+
+
+def extract_palette(source, k=4, size=SAMPLE_SIZE):
+    """
+    服の主な色（割合の大きい順）とトーンを返す。
+    ratio・confidence は背景を除いた服の画素に占める割合。
+    """
+    centers, counts = kmeans(garment_pixels(_load_pixels(source, size)), k)
+    ratios = counts / counts.sum()
+
+    # 同じ色名になったクラスタは1色にまとめる（代表値は割合の大きい方）
+    by_name = {}
+    tone_ratio = dict.fromkeys(TONES, 0.0)
+    for i in np.argsort(-ratios):
+        if ratios[i] == 0:
+            continue
+        rgb = centers[i]
+        name = _color_name(rgb)
+        color = by_name.setdefault(name, {
+            "name": name,
+            "hex": "#{:02x}{:02x}{:02x}".format(*(int(round(c)) for c in rgb)),
+            "ratio": 0.0,
+        })
+        color["ratio"] = round(color["ratio"] + float(ratios[i]), 3)
+        tone_ratio[_tone(rgb)] += float(ratios[i])
+    colors = sorted(by_name.values(), key=lambda c: -c["ratio"])
+
+    tone = max(tone_ratio, key=tone_ratio.get)
+    return Palette(colors, tone, round(tone_ratio[tone], 3))
+
+
+def describe(palette):
+    """
+    プロンプトに埋め込む短い説明文。
+    """
+    names = "、".join(f"{c['name']}({c['ratio']:.0%})" for c in palette.colors)
+    return f"主な色: {names}\n全体のトーン: {palette.tone}"
@@ -0,0 +1,210 @@
+# ================================
+# Flex Message テンプレート
+# ================================
+"""
+バブルのレイアウトを起動時に1回だけ定義し、返信のたびに差し込み部分
+（AIの文章・AmazonのURL）を埋めた dict を json.dumps で1回だけシリアライズする。
+FlexSendMessage のモデルクラスを通した検証・再シリアライズは行わない。
+
+差し込み値は LINE の上限に収まるように切り詰める。
+- テキスト: 文の区切りで切って「…」を付ける
+- URI: 1000文字まで（%エンコードの途中では切らない）
+- バブル全体: UTF-8 で 30KB まで（超えたら一番長いテキストを縮める）
+
+    COORDINATE = FlexTemplate("おすすめコーデ", {
+        "type": "bubble",
+        "body": {..., "contents": [{"type": "text", "text": text_slot("ai_text")}, ...]}
+    })
+    outbox.reply(event.reply_token, user_id, COORDINATE.render(ai_text=text))
+
+描画のベンチマーク:
+    python flex_templates.py
+"""
+import re
+import json
+
+MAX_BUBBLE_BYTES = 30 * 1024
+MAX_URI_CHARS = 1000
+MAX_ALT_TEXT_CHARS = 400
+DEFAULT_TEXT_CHARS = 2000
+
+_SENTENCE_ENDS = "。！？!?\n"
+
+
+class Slot:
+
+    def __init__(self, name, kind, max_chars):
+        self.name = name
+        self.kind = kind
+        self.max_chars = max_chars
+
+    def fill(self, value, max_chars=None):
+        value = "" if value is None else str(value)
+        if self.kind == "uri":
+            value = truncate_uri(value, self.max_chars)
+        else:
+            value = truncate_text(value, max_chars or self.max_chars)
+        return value
+
+
+def text_slot(name, max_chars=DEFAULT_TEXT_CHARS):
+    return Slot(name, "text", max_chars)
+
+
+def uri_slot(name):
+    return Slot(name, "uri", MAX_URI_CHARS)
+
+
+def truncate_text(text, max_chars):
+    """
+    max_chars 以内に収める。なるべく文の区切りで切り、末尾に「…」を付ける。
+    """
+    if len(text) <= max_chars:
+        return text
+    head = text[:max_chars - 1]
+    cut = max(head.rfind(c) for c in _SENTENCE_ENDS)
+    # 区切りが前すぎる場合は文字数で切る
+    if cut >= max_chars * 0.6:
+        head = head[:cut + 1]
+    return head.rstrip() + "…"
+
+
+def truncate_uri(uri, max_chars=MAX_URI_CHARS):
+    if len(uri) <= max_chars:
+        return uri
+    uri = uri[:max_chars]
+    # "%E3%8" のような途中の %エンコードを落とす
+    return re.sub(r'%[0-9A-Fa-f]?$', '', uri)
+
+
+class RenderedMessage:
+    """
+    シリアライズ済みのメッセージ。outbox はこの文字列をそのまま送る。
+    as_json_dict() は linebot の reply_message に直接渡す場合のため。
+    """
+
+    def __init__(self, json_string):
+        self.json_string = json_string
+
+    def as_json_string(self):
+        return self.json_string
+
+    def as_json_dict(self):
+        return json.loads(self.json_string)
+
+
+class FlexTemplate:
+
+    def __init__(self, alt_text, contents):
+        self.slots = {}
+        if isinstance(alt_text, str):
+            alt_text = truncate_text(alt_text, MAX_ALT_TEXT_CHARS)
+        self.message = {"type": "flex", "altText": alt_text, "contents": contents}
+        self._collect(self.message)
+
+    def _collect(self, node):
+        if isinstance(node, Slot):
+            self.slots[node.name] = node
+        elif isinstance(node, dict):
+            for v in node.values():
+                self._collect(v)
+        elif isinstance(node, list):
+            for v in node:
+                self._collect(v)
+
+    def _build(self, node, filled):
+        """
+        Slot を埋めた値に置き換えながらコピーする。
+        """
+        if isinstance(node, Slot):
+            return filled[node.name]
+        if isinstance(node, dict):
+            return {k: self._build(v, filled) for k, v in node.items()}
+        if isinstance(node, list):
+            return [self._build(v, filled) for v in node]
+        return node
+
+    def render(self, **values):
+        filled = {name: slot.fill(values.get(name)) for name, slot in self.slots.items()}
+        while True:
+            json_string = json.dumps(
+                self._build(self.message, filled), ensure_ascii=False, separators=(",", ":")
+            )
+            size = len(json_string.encode("utf-8"))
+            if size <= MAX_BUBBLE_BYTES:
+                return RenderedMessage(json_string)
+
+            # 上限を超えたら、一番長いテキストを超過分だけ縮めて作り直す
+            texts = [n for n, s in self.slots.items() if s.kind == "text" and len(filled[n]) > 1]
+            if not texts:
+                raise ValueError(f"flex message is {size} bytes (limit {MAX_BUBBLE_BYTES})")
+            name = max(texts, key=lambda n: len(filled[n].encode("utf-8")))
+            current = filled[name]
+            # 日本語は1文字3バイトなので、超過バイト数÷3 以上を削る
+            shrink = max(1, (size - MAX_BUBBLE_BYTES) // 3 + 1)
+            filled[name] = self.slots[name].fill(current, max(1, len(current) - shrink))
+
+
+# ================================
+# ベンチマーク
+# ================================
+def _bubble(text, tops, bottoms, shoes):
+    return {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "md",
+            "contents": [
+                {"type": "text", "text": "👕 おすすめコーデ", "weight": "bold", "size": "lg"},
+                {"type": "text", "text": text, "wrap": True, "size": "sm"},
+                {"type": "separator"},
+                {"type": "button", "style": "primary",
+                 "action": {"type": "uri", "label": "🛒 トップスをAmazonで見る", "uri": tops}},
+                {"type": "button", "style": "primary",
+                 "action": {"type": "uri", "label": "🛒 ボトムスをAmazonで見る", "uri": bottoms}},
+                {"type": "button", "style": "primary",
+                 "action": {"type": "uri", "label": "🛒 靴をAmazonで見る", "uri": shoes}},
+            ]
+        }
+    }
+
+
+def benchmark(number=20000):
+    import timeit
+
+    template = FlexTemplate(
+        "おすすめコーデ（Amazonリンク）",
+        _bubble(text_slot("ai_text"), uri_slot("tops"), uri_slot("bottoms"), uri_slot("shoes"))
+    )
+    text = "白シャツに黒のテーパードスラックスを合わせたきれいめコーデです。" * 10
+    uri = "https://www.amazon.co.jp/s?k=%E7%99%BD+%E3%82%B7%E3%83%A3%E3%83%84"
+
+    def dict_build():
+        message = {"type": "flex", "altText": "おすすめコーデ（Amazonリンク）",
+                   "contents": _bubble(text, uri, uri, uri)}
+        return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+    def template_render():
+        return template.render(ai_text=text, tops=uri, bottoms=uri, shoes=uri).as_json_string()
+
+    cases = [("dict + json.dumps", dict_build), ("template.render", template_render)]
+    try:
+        from linebot.models import FlexSendMessage
+
+        def sdk_build():
+            message = FlexSendMessage(alt_text="おすすめコーデ（Amazonリンク）",
+                                      contents=_bubble(text, uri, uri, uri))
+            return json.dumps(message.as_json_dict())
+
+        cases.insert(0, ("FlexSendMessage", sdk_build))
+    except ImportError:
+        pass
+
+    for label, func in cases:
+        elapsed = timeit.timeit(func, number=number)
+        print(f"{label:<20} {elapsed / number * 1e6:8.1f} us/render")
+
+
+if __name__ == "__main__":
+    benchmark()
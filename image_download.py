@@ -0,0 +1,189 @@
+# ================================
+# LINE画像のストリーミング取得
+# ================================
+"""
+get_message_content(...).content は本文全体をバッファしたうえで、
+呼び出し側でさらに hex 文字列や BytesIO にコピーしていた。
+
+ここではチャンクごとに1つの事前確保バッファへ書き込み、
+上限サイズを超えたら打ち切り、読みながら SHA-256 も計算する。
+呼び出し側へは bytearray / memoryview をそのまま渡す。
+
+メモリ使用量のベンチマーク:
+    python image_download.py
+"""
+import io
+import os
+import hashlib
+
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', str(10 * 1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageTooLargeError(Exception):
+    pass
+
+
+class DownloadedImage:
+    """
+    取得した画像。
+    - buffer: 実サイズの bytearray（boto3 の Bytes や DynamoDB の Binary にそのまま渡せる）
+    - view:   コピーなしで切り出せる memoryview
+    - sha256: 読み込みと同時に計算したハッシュ
+    """
+
+    def __init__(self, buffer, sha256, content_type):
+        self.buffer = buffer
+        self.sha256 = sha256
+        self.content_type = content_type or "image/jpeg"
+
+    @property
+    def size(self):
+        return len(self.buffer)
+
+    @property
+    def view(self):
+        return memoryview(self.buffer)
+
+    def open(self):
+        """
+        PIL などファイルを受け取る処理向けの、コピーしない読み取りストリーム。
+        """
+        return io.BufferedReader(_MemoryviewReader(self.view))
+
+    def tobytes(self):
+        # protobuf の bytes フィールド（Gemini）は bytes 以外を受け付けないため、ここだけコピーする
+        return bytes(self.buffer)
+
+
+class _MemoryviewReader(io.RawIOBase):
+
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+def read_content(content, max_bytes=MAX_IMAGE_BYTES, chunk_size=CHUNK_SIZE):
+    """
+    linebot の Content（stream=True で取得済み）を1つのバッファに読み込む。
+    Content-Length があればそのサイズで、なければ上限サイズで確保する。
+    """
+    declared = int(content.response.headers.get('content-length') or 0)
+    if declared > max_bytes:
+        raise ImageTooLargeError(f"image is {declared} bytes (limit {max_bytes})")
+
+    buffer = bytearray(declared or max_bytes)
+    view = memoryview(buffer)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        for chunk in content.iter_content(chunk_size):
+            end = size + len(chunk)
+            if end > max_bytes:
+                raise ImageTooLargeError(f"image exceeds {max_bytes} bytes")
+            if end > len(buffer):
+                # Content-Length より長く届いた場合だけ上限まで広げる
+                view.release()
+                buffer.extend(bytes(max_bytes - len(buffer)))
+                view = memoryview(buffer)
+            view[size:end] = chunk
+            digest.update(chunk)
+            size = end
+    finally:
+        view.release()
+
+    # 余りを切り詰める（bytearray の縮小はその場で行われる）
+    del buffer[size:]
+    return DownloadedImage(buffer, digest.hexdigest(), content.content_type)
+
+
+def download_image(line_bot_api, message_id, max_bytes=MAX_IMAGE_BYTES, chunk_size=CHUNK_SIZE):
+    content = line_bot_api.get_message_content(message_id)
+    return read_content(content, max_bytes, chunk_size)
+
+
+# ================================
+# ベンチマーク（メモリ最大使用量）
+# ================================
+class _FakeResponse:
+
+    def __init__(self, payload):
+        self.headers = {'content-length': str(len(payload)), 'content-type': 'image/jpeg'}
+
+
+class _FakeContent:
+    """
+    ネットワークから chunk_size ずつ届く Content の代わり。
+    """
+
+    def __init__(self, payload):
+        self._payload = payload
+        self.response = _FakeResponse(payload)
+        self.content_type = 'image/jpeg'
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        for i in range(0, len(self._payload), chunk_size):
+            yield self._payload[i:i + chunk_size]
+
+    @property
+    def content(self):
+        # requests の Response.content と同じくチャンクを連結する
+        return b"".join(self.iter_content())
+
+
+def _peak(func):
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(size=5 * 1024 * 1024):
+    payload = os.urandom(size)
+
+    def legacy():
+        image_bytes = _FakeContent(payload).content
+        hex_data = image_bytes.hex()                 # line_function2 の DynamoDB 保存
+        stream = io.BytesIO(image_bytes)             # line_function-main の PIL 用
+        hashlib.sha256(image_bytes).hexdigest()
+        return hex_data, stream
+
+    def streaming():
+        image = read_content(_FakeContent(payload))
+        stream = image.open()
+        return image, stream
+
+    mib = 1024 * 1024
+    print(f"payload: {size / mib:.1f} MiB")
+    print(f"legacy    peak: {_peak(legacy) / mib:.1f} MiB")
+    print(f"streaming peak: {_peak(streaming) / mib:.1f} MiB")
+
+
+if __name__ == "__main__":
+    benchmark()
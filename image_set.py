@@ -0,0 +1,155 @@
+# ================================
+# 画像セット（複数枚同時送信）のまとめ処理
+# ================================
+"""
+LINE で複数枚の写真をまとめて送ると、1枚ずつ別の ImageMessage として届き、
+同じ imageSet.id（と index / total）を持つ。
+1枚ごとに解析・返信すると N 回の Gemini 呼び出しと N 通の返信になるので、
+セットの画像を DynamoDB に集め、1回の呼び出しと1通の返信にまとめる。
+
+- 画像は別々の Webhook（別々の Lambda 呼び出し）で届くことがある
+- add() はセットの記録に画像を追加するだけで、すぐ戻る
+- collect() は lambda_handler の最後に呼ぶ。セットが揃うか待ち時間が過ぎたら、
+  条件付き更新で「担当」を1つの呼び出しだけに決めて process を呼ぶ
+- 担当になれなかった呼び出しは何もしない（返信は担当の返信トークンで1通だけ）
+
+    image_sets = ImageSetAggregator(table, key=lambda user_id, set_id: {"id": f"imageset:{set_id}"})
+
+    # handle_image
+    ref = image_set_of(event.message)
+    if ref:
+        image_sets.add(user_id, event.reply_token, ref, event.message.id)
+
+    # lambda_handler
+    image_sets.collect(process)   # process(user_id, reply_token, message_ids)
+"""
+import os
+import time
+import threading
+from collections import namedtuple
+
+from botocore.exceptions import ClientError
+
+# セットが揃うのを待つ最大秒数（揃わなければ届いた分だけで処理する）
+IMAGE_SET_WINDOW_SECONDS = float(os.environ.get('IMAGE_SET_WINDOW_SECONDS', '4'))
+IMAGE_SET_POLL_SECONDS = float(os.environ.get('IMAGE_SET_POLL_SECONDS', '0.5'))
+# DynamoDB の TTL で記録を消すまでの秒数
+IMAGE_SET_TTL_SECONDS = int(os.environ.get('IMAGE_SET_TTL_SECONDS', '600'))
+
+ImageSetRef = namedtuple("ImageSetRef", ["id", "index", "total"])
+
+
+def image_set_of(message):
+    """
+    メッセージの imageSet を返す。単体の画像なら None。
+    SDK の ImageMessage と Webhook の dict のどちらも受け付ける。
+    """
+    if isinstance(message, dict):
+        image_set = message.get("imageSet")
+    else:
+        image_set = getattr(message, "image_set", None)
+    if not image_set:
+        return None
+    if isinstance(image_set, dict):
+        return ImageSetRef(image_set["id"], image_set.get("index", 1), image_set.get("total", 1))
+    return ImageSetRef(image_set.id, image_set.index or 1, image_set.total or 1)
+
+
+def _message_ids(item):
+    # "index:message_id" の文字列セットを index 順の message_id に戻す
+    entries = sorted(
+        (entry.split(":", 1) for entry in item.get("images", ())),
+        key=lambda pair: int(pair[0])
+    )
+    return [message_id for _, message_id in entries]
+
+
+class ImageSetAggregator:
+
+    def __init__(self, table, key, window=IMAGE_SET_WINDOW_SECONDS,
+                 poll=IMAGE_SET_POLL_SECONDS, ttl=IMAGE_SET_TTL_SECONDS):
+        self.table = table
+        self.key = key
+        self.window = window
+        self.poll = poll
+        self.ttl = ttl
+        # この呼び出し（スレッド）で受け取ったセット
+        self._local = threading.local()
+
+    def _pending(self):
+        if not hasattr(self._local, "sets"):
+            self._local.sets = {}
+        return self._local.sets
+
+    def add(self, user_id, reply_token, ref, message_id):
+        """
+        セットの記録に画像を追加する。返信トークンは最後に受け取ったものを使う。
+        """
+        self.table.update_item(
+            Key=self.key(user_id, ref.id),
+            UpdateExpression="ADD images :m SET #t = :t, expires_at = :e",
+            ExpressionAttributeNames={"#t": "total"},
+            ExpressionAttributeValues={
+                ":m": {f"{ref.index}:{message_id}"},
+                ":t": ref.total,
+                ":e": int(time.time()) + self.ttl,
+            },
+            ReturnValues="NONE"
+        )
+        self._pending()[(user_id, ref.id)] = (reply_token, ref.total)
+
+    def _wait(self, key, total, deadline):
+        """
+        揃うか期限が来るまで待つ。ほかの呼び出しが担当済みなら False。
+        """
+        while True:
+            item = self.table.get_item(Key=key, ConsistentRead=True).get("Item", {})
+            if item.get("claimed"):
+                return False
+            if len(item.get("images", ())) >= total or time.monotonic() >= deadline:
+                return True
+            time.sleep(self.poll)
+
+    def _claim(self, key):
+        """
+        担当を取る。取れたら確定した記録を、取れなければ None を返す。
+        """
+        try:
+            return self.table.update_item(
+                Key=key,
+                UpdateExpression="SET claimed = :c",
+                ConditionExpression="attribute_not_exists(claimed)",
+                ExpressionAttributeValues={":c": int(time.time())},
+                ReturnValues="ALL_NEW"
+            )["Attributes"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                return None
+            raise
+
+    def collect(self, process):
+        """
+        この呼び出しで受け取ったセットのうち、担当になったものだけ
+        process(user_id, reply_token, message_ids) を呼ぶ。処理したセット数を返す。
+        """
+        sets = self._pending()
+        self._local.sets = {}
+        deadline = time.monotonic() + self.window
+        processed = 0
+        for (user_id, set_id), (reply_token, total) in sets.items():
+            key = self.key(user_id, set_id)
+            if not self._wait(key, total, deadline):
+                continue
+            item = self._claim(key)
+            if item is None:
+                continue
+            message_ids = _message_ids(item)
+            if len(message_ids) < total:
+                print(f"image set {set_id}: {len(message_ids)}/{total} images after {self.window}s")
+            try:
+                process(user_id, reply_token, message_ids)
+                processed += 1
+            except Exception as e:
+                # 担当済みなので再処理はされない。ほかのセットは続ける
+                print(f"image set {set_id} error: {e}")
+        return processed
@@ -6,29 +6,31 @@ import boto3
 import google.generativeai as genai
 import pickle
 import tempfile
-import io
 from PIL import Image
-import json
-from linebot import LineBotApi, WebhookHandler
+from linebot import LineBotApi
 from linebot.models import (
     MessageEvent, TextMessage, ImageMessage, TextSendMessage,
     TemplateSendMessage, ButtonsTemplate, MessageAction
 )
+from image_download import download_image
+from outbox import Outbox
+from webhook_ingest import Ingestor
+import prompts
 
 # ================================
 # LINE Bot API設定
 # ================================
 line_bot_api = LineBotApi(os.environ.get('CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.environ.get('CHANNEL_SECRET'))
+handler = Ingestor(os.environ.get('CHANNEL_SECRET'))
+outbox = Outbox(line_bot_api)
 
 # ================================
 # Google Gemini API設定
 # ================================
 genai.configure(api_key=os.environ.get('GOOGLE_API_KEY'))
 
-# 画像解析用（Vision）とテキスト生成用（会話）
+# テキスト生成用（会話）。画像からのコーデは prompts.py の image_styling を使う
 gemini_text = genai.GenerativeModel("gemini-2.0.-flash")   # 軽量高速モデル
-gemini_vision = genai.GenerativeModel("gemini-2.0-flash") # 画像入力対応
 
 # ================================
 # AWS SDK設定
@@ -79,21 +81,21 @@ def handle_text_message(event: MessageEvent):
                 ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, message)
+        outbox.reply(event.reply_token, user_id, message)
         return
 
     # --- 写真モードの案内 ---
     if "写真から" in user_text:
-        line_bot_api.reply_message(
-            event.reply_token,
+        outbox.reply(
+            event.reply_token, user_id,
             TextSendMessage(text="📸 服の写真を送ってください！AIがコーデを提案します。")
         )
         return
 
     # --- テキストモード処理 ---
     if "テキストから" in user_text:
-        line_bot_api.reply_message(
-            event.reply_token,
+        outbox.reply(
+            event.reply_token, user_id,
             TextSendMessage(text="📝 どんなシーンのコーデを考えていますか？（例：デート・通学・オフィスなど）")
         )
         return
@@ -104,8 +106,8 @@ def handle_text_message(event: MessageEvent):
 
     reply_text = response.text.strip() if response and response.text else "すみません、うまく提案できませんでした。"
 
-    line_bot_api.reply_message(
-        event.reply_token,
+    outbox.reply(
+        event.reply_token, user_id,
         TextSendMessage(text=reply_text)
     )
 
@@ -127,26 +129,11 @@ def handle_image_message(event: MessageEvent):
         if 'style' in item:
             user_style = item['style']
     
-    message_id = event.massage.id
-    message_content = line_bot_api.get_massage_content(message_id)
-    image_binary = message_content.content
-
-    img = Image.open(io.BytesIO(image_binary))
-
-    prompt = f"""
-    あなたはプロのファッションスタイリストです。
-    ユーザーから送られた写真の服をメインに使って、以下の条件に合うおしゃれなコーデを複数パターン提案してください。
-
-    【条件】
-    ・今日の天気: {weather_info}
-    ・ユーザーの好み: {user_style}
-    ・出力形式:タイトルと具体的なアイテムの組み合わせ、着こなしのポイントを簡潔に。
-
-    提案の最後には、「このコーデに合うアイテムを探す」と一言添えてください。
-    """
+    image = download_image(line_bot_api, event.message.id)
+    img = Image.open(image.open())
 
     try:
-        response = gemini_model.generate_content([prompt, img])
+        response = prompts.generate("image_styling", img, weather=weather_info, style=user_style)
         return_message = response.text
 
     except Exception as e:
@@ -154,9 +141,9 @@ def handle_image_message(event: MessageEvent):
         return_message = "申し訳ありません。コーデの生成に失敗しました。"
  
     # LINEに返信
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=retrun_message)
+    outbox.reply(
+        event.reply_token, user_id,
+        TextSendMessage(text=return_message)
     )
  
 
@@ -164,10 +151,9 @@ def handle_image_message(event: MessageEvent):
 # Lambdaエントリポイント
 # ================================
 def lambda_handler(event, context):
+    # 本文は文字列のまま渡す（署名検証とパースは Ingestor で1回だけ）
     try:
-        body = json.loads(event["body"])
-        signature = event["headers"]["x-line-signature"]
-        handler.handle(body["events"][0], signature)
-    except Exception as e:
-        print("Error:", e)
+        handler.handle(event["body"], event["headers"]["x-line-signature"])
+    finally:
+        outbox.flush()
     return {"statusCode": 200, "body": "OK"}
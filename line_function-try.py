@@ -5,10 +5,11 @@ import google.generativeai as genai
 import pickle
 from botocore.exceptions import ClientError
 import requests
-from linebot import LineBotApi, WebhookHandler
+from linebot import LineBotApi
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, ImageMessage,
-    TemplateSendMessage, ButtonsTemplate, FlexSendMessage,
+    TemplateSendMessage, ButtonsTemplate,
     BubbleContainer, BoxComponent, TextComponent, ButtonComponent,
     MessageAction, QuickReply, QuickReplyButton,
     LocationMessage, LocationAction
@@ -16,7 +17,26 @@ from linebot.models import (
 
 import re
 import json
+import time
+import hashlib
+import threading
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import location_bucket
+import wizard_state
+import prompts
+from image_download import download_image
+from image_set import ImageSetAggregator, image_set_of
+from outbox import Outbox
+from webhook_ingest import Ingestor
+from flex_templates import FlexTemplate, text_slot, uri_slot
+
+try:
+    import color_palette
+except ImportError:
+    # numpy / Pillow が無い環境では Rekognition のみで解析する
+    color_palette = None
 
 # ======================
 # Amazon検索リンク生成
@@ -40,14 +60,165 @@ def build_keywords(session: dict):
     }
 
 
+# ======================
+# Flex Messageテンプレート（起動時に1回だけコンパイル）
+# ======================
+COORDINATE_FLEX = FlexTemplate("おすすめコーデ（Amazonリンク）", {
+    "type": "bubble",
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "spacing": "md",
+        "contents": [
+            {
+                "type": "text",
+                "text": "👕 おすすめコーデ",
+                "weight": "bold",
+                "size": "lg"
+            },
+            {
+                "type": "text",
+                "text": text_slot("ai_text"),
+                "wrap": True,
+                "size": "sm"
+            },
+            {
+                "type": "separator"
+            },
+            {
+                "type": "button",
+                "style": "primary",
+                "action": {
+                    "type": "uri",
+                    "label": "🛒 トップスをAmazonで見る",
+                    "uri": uri_slot("tops")
+                }
+            },
+            {
+                "type": "button",
+                "style": "primary",
+                "action": {
+                    "type": "uri",
+                    "label": "🛒 ボトムスをAmazonで見る",
+                    "uri": uri_slot("bottoms")
+                }
+            },
+            {
+                "type": "button",
+                "style": "primary",
+                "action": {
+                    "type": "uri",
+                    "label": "🛒 靴をAmazonで見る",
+                    "uri": uri_slot("shoes")
+                }
+            }
+        ]
+    }
+})
+
+IMAGE_COORDINATE_FLEX = FlexTemplate("画像からおすすめコーデ（Amazon）", {
+    "type": "bubble",
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "paddingAll": "12px",
+        "spacing": "sm",
+        "contents": [
+            {
+                "type": "text",
+                "text": "📸 画像からのコーデ提案",
+                "weight": "bold",
+                "size": "lg"
+            },
+            {
+                "type": "text",
+                "text": text_slot("ai_text"),
+                "wrap": True,
+                "size": "sm"
+            },
+            {"type": "separator"},
+            {
+                "type": "button",
+                "style": "primary",
+                "action": {
+                    "type": "uri",
+                    "label": "🛒 トップスを見る",
+                    "uri": uri_slot("tops")
+                }
+            },
+            {
+                "type": "button",
+                "style": "primary",
+                "action": {
+                    "type": "uri",
+                    "label": "🛒 ボトムスを見る",
+                    "uri": uri_slot("bottoms")
+                }
+            },
+            {
+                "type": "button",
+                "style": "primary",
+                "action": {
+                    "type": "uri",
+                    "label": "🛒 靴を見る",
+                    "uri": uri_slot("shoes")
+                }
+            }
+        ]
+    }
+})
+
 # -------------------------------
 # 設定
 # -------------------------------
-line_bot_api = LineBotApi(os.environ.get('CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.environ.get('CHANNEL_SECRET'))
+# 接続プールの大きさ。server.py ではワーカー数（SERVER_WORKERS）に合わせる
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', os.environ.get('SERVER_WORKERS', '16')))
+
+class SessionHttpClient(RequestsHttpClient):
+    """
+    LineBotApi 標準の HTTP クライアントは呼び出しのたびに新しい接続を張るので、
+    requests.Session を使い回して LINE API への接続（TLS）を再利用する。
+    """
+
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT, pool_maxsize=HTTP_POOL_MAXSIZE):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        self.session.mount(
+            "https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+        )
 
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return RequestsHttpResponse(self.session.get(
+            url, headers=headers, params=params, stream=stream,
+            timeout=timeout if timeout is not None else self.timeout
+        ))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.post(
+            url, headers=headers, data=data,
+            timeout=timeout if timeout is not None else self.timeout
+        ))
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.delete(
+            url, headers=headers, data=data,
+            timeout=timeout if timeout is not None else self.timeout
+        ))
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.put(
+            url, headers=headers, data=data,
+            timeout=timeout if timeout is not None else self.timeout
+        ))
+
+
+line_bot_api = LineBotApi(os.environ.get('CHANNEL_ACCESS_TOKEN'), http_client=SessionHttpClient)
+handler = Ingestor(os.environ.get('CHANNEL_SECRET'))
+# 返信はここに溜めて、lambda_handler の最後にまとめて送る
+outbox = Outbox(line_bot_api)
+
+# プロンプトと生成設定は prompts.py に集約
 genai.configure(api_key=os.environ.get('GOOGLE_API_KEY'))
-gemini_model = genai.GenerativeModel("gemini-2.5-flash")
 
 s3 = boto3.client('s3')
 S3_BUCKET = os.environ['S3_BUCKET']
@@ -56,22 +227,56 @@ rekognition = boto3.client('rekognition')
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table('linebot')   # ←必要ならテーブル名を変更してください
 
+# Lambda 上で動いているか（返却後にコンテナが凍結される）
+IN_LAMBDA = bool(os.environ.get('AWS_LAMBDA_FUNCTION_NAME'))
+# 先読み生成したコーデ案の有効期限（秒）
+SPECULATIVE_TTL_SECONDS = int(os.environ.get('SPECULATIVE_TTL_SECONDS', '600'))
+# Lambda終了前に先読みスレッドを待つ最大秒数
+SPECULATIVE_JOIN_TIMEOUT = float(os.environ.get('SPECULATIVE_JOIN_TIMEOUT', '20'))
+# "0" にすると位置情報での手直しをせず、先読み案をそのまま返す
+SPECULATIVE_REFINE = os.environ.get('SPECULATIVE_REFINE', '1') != '0'
+
+# Rekognition の使い方: always（常に）/ fallback（配色解析の確信度が低い時だけ）/ never
+REKOGNITION_MODE = os.environ.get('REKOGNITION_MODE', 'fallback')
+# 配色解析の結果をそのまま使う確信度の下限
+PALETTE_MIN_CONFIDENCE = float(os.environ.get('PALETTE_MIN_CONFIDENCE', '0.5'))
+
+# Gemini の本文が返らなかった時の文章（Flex の検索リンクは build_keywords で組み立てる）
+FALLBACK_COORDINATE_TEXT = "コーデの文章を作れませんでした。条件に合うアイテムのリンクをお送りします。"
+
+# 複数枚まとめて送られた画像は、同じテーブルに "imageset:{id}" のキーで集める
+image_sets = ImageSetAggregator(
+    table, key=lambda user_id, set_id: {"id": f"imageset:{set_id}"}
+)
+# 画像セットのダウンロード・解析の並列数
+IMAGE_SET_WORKERS = int(os.environ.get('IMAGE_SET_WORKERS', '4'))
+
 # -------------------------------
 # DynamoDBユーティリティ
 # -------------------------------
+# ウィザードの回答は wizard_state で1つの Map 属性 "w" にまとめて保存する
+# 最後の保存からこの秒数で DynamoDB の TTL により項目が消える（テーブルで expires_at を TTL 属性に設定）
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', str(7 * 24 * 3600)))
+
 def save_session(user_id: str, key: str, value):
     """
     会話で選んだ項目を保存（上書き更新）。
-    - key は DynamoDB の属性名（任意の文字列）を想定
-    - value は文字列/数値/リストなど（boto3が自動でDynamoDB形式に変換）
+    - ウィザードの回答（wizard_state.KEYS）は wizard_state.save_answer で "w" の1要素だけを書く
+      （読み込みなしの1回の書き込み）
+    - それ以外（draft など）は key をそのまま属性名にする
+    - どちらの場合も expires_at（TTL）を延長する
     安全のため ExpressionAttributeNames を使って予約語を避ける。
     """
+    expires_at = int(time.time()) + SESSION_TTL_SECONDS
     try:
+        if key in wizard_state.KEYS:
+            wizard_state.save_answer(table, {"id": user_id}, key, value, expires_at)
+            return
         table.update_item(
             Key={"id": user_id},
-            UpdateExpression="SET #k = :v",
-            ExpressionAttributeNames={"#k": key},
-            ExpressionAttributeValues={":v": value},
+            UpdateExpression="SET #k = :v, #e = :e",
+            ExpressionAttributeNames={"#k": key, "#e": wizard_state.TTL_ATTR},
+            ExpressionAttributeValues={":v": value, ":e": expires_at},
             ReturnValues="NONE"
         )
     except ClientError as e:
@@ -79,17 +284,157 @@ def save_session(user_id: str, key: str, value):
         print(f"save_session error: {e}")
         raise
 
-def get_session(user_id: str) -> dict:
+def get_session(user_id: str, consistent: bool = False) -> dict:
     """
     保存されたユーザーの会話内容をすべて取得。
-    - ユーザーが存在しない場合は空辞書を返す
+    - ウィザードの回答は "w" から元のキー（gender, category, ... area）に戻す
+    - 旧形式の項目も同じキーで返す（答え直した項目から "w" に移る）
+    - ユーザーが存在しない・期限切れの場合は空辞書を返す
+    - 直前に保存した値を確実に読む必要がある時は consistent=True（強い整合性）
     """
     try:
-        resp = table.get_item(Key={"id": user_id})
-        return resp.get("Item", {}) or {}
+        resp = table.get_item(Key={"id": user_id}, ConsistentRead=consistent)
+        item = resp.get("Item", {}) or {}
     except ClientError as e:
         print(f"get_session error: {e}")
         return {}
+    return wizard_state.session_from_item(item)
+
+def remove_session_keys(user_id: str, *keys):
+    """
+    指定した属性をセッションから削除する。
+    - 存在しない属性を指定してもエラーにはならない
+    """
+    if not keys:
+        return
+    names = {f"#k{i}": key for i, key in enumerate(keys)}
+    try:
+        table.update_item(
+            Key={"id": user_id},
+            UpdateExpression="REMOVE " + ", ".join(names),
+            ExpressionAttributeNames=names,
+            ReturnValues="NONE"
+        )
+    except ClientError as e:
+        print(f"remove_session_keys error: {e}")
+
+# -------------------------------
+# コーデ提案プロンプト
+# -------------------------------
+PROFILE_KEYS = ("gender", "age", "category", "color", "season", "budget")
+
+def coordinate_values(session: dict, place: str = None) -> dict:
+    """
+    セッションの条件を prompts の "coordinate" テンプレートの値にする。
+    - place が None の場合は「行く場所」を含めない（先読み生成用）
+    """
+    return {
+        "gender": session.get('gender', 'メンズ'),
+        "age": session.get('age', '20代'),
+        "category": session.get('category', 'カジュアル'),
+        "color": session.get('color', '白'),
+        "season": session.get('season', '春'),
+        "budget": session.get('budget', '普通'),
+        "place": f" 行く場所:{place}" if place is not None else "",
+    }
+
+# -------------------------------
+# 先読み生成
+# -------------------------------
+# 予算まで選ばれた時点で、住所以外の条件はすべて揃っている。
+# 位置情報を待たずに場所なしのコーデ案を裏で作ってセッションに保存し、
+# handle_location では短い手直しだけで済ませる。
+_speculative_lock = threading.Lock()
+_speculative_jobs = {}      # user_id -> 実行中ジョブのトークン
+_speculative_threads = []
+
+def profile_fingerprint(session: dict) -> str:
+    """
+    先読み案を作った時点の条件を識別するハッシュ。
+    条件が変わっていれば先読み案は使わない。
+    """
+    raw = "|".join(str(session.get(k, "")) for k in PROFILE_KEYS)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+def start_speculative_draft(user_id: str):
+    """
+    場所なしのコーデ案の生成をバックグラウンドで開始する。
+    同じユーザーの実行中ジョブがあれば、そちらの結果は破棄される。
+    """
+    token = object()
+    with _speculative_lock:
+        _speculative_jobs[user_id] = token
+    thread = threading.Thread(
+        target=_run_speculative_draft, args=(user_id, token), daemon=True
+    )
+    # 待つ必要があるのは Lambda だけ（常駐サーバーで溜め続けないように）
+    if IN_LAMBDA:
+        _speculative_threads.append(thread)
+    thread.start()
+
+def _run_speculative_draft(user_id: str, token):
+    try:
+        # 予算を保存した直後なので、古い値を読まないように強い整合性で読む
+        session = get_session(user_id, consistent=True)
+        text = prompts.generate("coordinate", **coordinate_values(session)).text
+        # キャンセル済み・新しいジョブに置き換え済みなら保存しない
+        # （ロックは確認の間だけ持ち、DynamoDB への書き込み中は持たない）
+        with _speculative_lock:
+            if _speculative_jobs.get(user_id) is not token:
+                return
+        save_session(user_id, "draft", {
+            "text": text,
+            "profile": profile_fingerprint(session),
+            "expires_at": int(time.time()) + SPECULATIVE_TTL_SECONDS,
+        })
+        # 書き込み中にキャンセルされていたら消す
+        # （新しいジョブに置き換わった場合はそちらが上書きし、古い案は profile の不一致で使われない）
+        with _speculative_lock:
+            cancelled = user_id not in _speculative_jobs
+        if cancelled:
+            remove_session_keys(user_id, "draft")
+    except Exception as e:
+        print(f"speculative draft error: {e}")
+    finally:
+        with _speculative_lock:
+            if _speculative_jobs.get(user_id) is token:
+                del _speculative_jobs[user_id]
+
+def cancel_speculative_draft(user_id: str):
+    """
+    ウィザードのやり直し時に、実行中のジョブと保存済みの先読み案を破棄する。
+    """
+    with _speculative_lock:
+        _speculative_jobs.pop(user_id, None)
+    remove_session_keys(user_id, "draft")
+
+def take_speculative_draft(user_id: str, session: dict):
+    """
+    使える先読み案があれば取り出して返す（1回限り）。
+    - 期限切れ・条件不一致のものは None
+    """
+    draft = session.get("draft")
+    if not draft:
+        return None
+    remove_session_keys(user_id, "draft")
+    if int(draft.get("expires_at", 0)) < time.time():
+        return None
+    if draft.get("profile") != profile_fingerprint(session):
+        return None
+    return draft.get("text")
+
+def wait_speculative_drafts(timeout: float = SPECULATIVE_JOIN_TIMEOUT):
+    """
+    Lambdaは返却後にコンテナが凍結されるため、終了前に先読みスレッドを待つ。
+    （返信はすでに送信済みなので、ユーザーの待ち時間には影響しない）
+    """
+    if not IN_LAMBDA:
+        # 常駐サーバー（server.py）ではプロセスが生き続けるので待たない
+        return
+    deadline = time.time() + timeout
+    while _speculative_threads:
+        thread = _speculative_threads.pop()
+        thread.join(max(0.0, deadline - time.time()))
 
 # -------------------------------
 # テキストメッセージ受信時の処理
@@ -106,56 +451,57 @@ def handle_message(event):
     # -------------------------
     if user_message == "画像から生成":
         reply = TextSendMessage(text="画像を送信してください！")
-        line_bot_api.reply_message(event.reply_token, reply)
+        outbox.reply(event.reply_token, user_id, reply)
         return
 
     # -------------------------
     # テキストから生成スタート
     # -------------------------
     elif user_message == "テキストから生成":
+        cancel_speculative_draft(user_id)
         message = TextSendMessage(
             text="どちらの性別のコーデを希望しますか？",
             quick_reply=QuickReply(
                 items=[
                     QuickReplyButton(action=MessageAction(label=label, text=label))
-                    for label in ["男性", "女性"]
+                    for label in wizard_state.GENDERS
                 ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, message)
+        outbox.reply(event.reply_token, user_id, message)
         return
 
-    elif user_message in ["男性"]:
+    elif user_message == "男性":
         save_session(user_id, "gender", user_message)
         message = TextSendMessage(
             text="どんなカテゴリーでコーデを組みますか？",
             quick_reply=QuickReply(
                 items=[
                     QuickReplyButton(action=MessageAction(label=label, text=label))
-                    for label in ["カジュアル系", "アメカジ","綺麗系", "フォーマル", "スポーツ","ビンテージ", "デザイナーズ","ストリート","地雷系"]
+                    for label in wizard_state.CATEGORIES_MEN
                 ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, message)
+        outbox.reply(event.reply_token, user_id, message)
         return
 
-    elif user_message in ["女性"]:
+    elif user_message == "女性":
         save_session(user_id, "gender", user_message)
         message = TextSendMessage(
             text="どんなカテゴリーでコーデを組みますか？",
             quick_reply=QuickReply(
                 items=[
                     QuickReplyButton(action=MessageAction(label=label, text=label))
-                    for label in ["カジュアル系","綺麗系", "フォーマル", "スポーツ","エレガンス","ガーリー","デザイナーズ","ストリート","地雷系"]
+                    for label in wizard_state.CATEGORIES_WOMEN
                 ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, message)
+        outbox.reply(event.reply_token, user_id, message)
         return
     # -------------------------
     # カテゴリー選択
     # -------------------------
-    elif user_message in ["カジュアル系", "綺麗系", "フォーマル", "スポーツ", "ストリート","エレガンス","ガーリー","アメカジ","ビンテージ","デザイナーズ","地雷系"]:
+    elif user_message in wizard_state.CATEGORIES:
         # 保存
         save_session(user_id, "category", user_message)
         message = TextSendMessage(
@@ -163,17 +509,17 @@ def handle_message(event):
             quick_reply=QuickReply(
                 items=[
                     QuickReplyButton(action=MessageAction(label=label, text=label))
-                    for label in ["10代", "20代", "30代", "40代", "50代", "60代以上"]
+                    for label in wizard_state.AGES
                 ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, message)
+        outbox.reply(event.reply_token, user_id, message)
         return
 
     # -------------------------
     # 年齢選択
     # -------------------------
-    elif user_message in ["10代", "20代", "30代", "40代", "50代", "60代以上"]:
+    elif user_message in wizard_state.AGES:
         save_session(user_id, "age", user_message)
 
         message = TextSendMessage(
@@ -181,14 +527,14 @@ def handle_message(event):
             quick_reply=QuickReply(
                 items=[
                     QuickReplyButton(action=MessageAction(label=label, text=label))
-                    for label in ["明るめな色", "暗めな色", "派手目の色", "落ち着いた色", "モノトーン"]
+                    for label in wizard_state.COLORS
                 ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, message)
+        outbox.reply(event.reply_token, user_id, message)
         return
 
-    elif user_message in ["明るめな色", "暗めな色", "派手目の色", "落ち着いた色", "モノトーン"]:
+    elif user_message in wizard_state.COLORS:
         save_session(user_id, "color", user_message)
 
         message = TextSendMessage(
@@ -196,18 +542,18 @@ def handle_message(event):
             quick_reply=QuickReply(
                 items=[
                     QuickReplyButton(action=MessageAction(label=label, text=label))
-                    for label in ["春", "夏", "秋", "冬"]
+                    for label in wizard_state.SEASONS
                 ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, message)
+        outbox.reply(event.reply_token, user_id, message)
         return
 
 
     # -------------------------
     # 色選択
     # -------------------------
-    elif user_message in ["春", "夏", "秋", "冬"]:
+    elif user_message in wizard_state.SEASONS:
         save_session(user_id, "season", user_message)
 
         message = TextSendMessage(
@@ -215,23 +561,17 @@ def handle_message(event):
             quick_reply=QuickReply(
                 items=[
                     QuickReplyButton(action=MessageAction(label=label, text=label))
-                    for label in [
-                        "10000円以内",
-                        "10000円〜20000円",
-                        "20000円〜30000円",
-                        "30000円以上",
-                        "特に気にしない"
-                    ]
+                    for label in wizard_state.BUDGETS
                 ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, message)
+        outbox.reply(event.reply_token, user_id, message)
         return
 
     # -------------------------
     # 予算選択
     # -------------------------
-    elif user_message in ["10000円以内", "10000円〜20000円", "20000円〜30000円", "30000円以上", "特に気にしない"]:
+    elif user_message in wizard_state.BUDGETS:
         save_session(user_id, "budget", user_message)
 
         message = TextSendMessage(
@@ -243,7 +583,10 @@ def handle_message(event):
                 ]
             )
         )
-        line_bot_api.reply_message(event.reply_token, message)
+        outbox.reply(event.reply_token, user_id, message)
+
+        # 位置情報を待つ間に、場所なしのコーデ案を先に作っておく
+        start_speculative_draft(user_id)
         return
 
     # -------------------------
@@ -252,7 +595,7 @@ def handle_message(event):
     elif user_message in ["履歴", "会話履歴", "ログ"]:
         session = get_session(user_id)
         if not session:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="まだ保存されたデータがありません。"))
+            outbox.reply(event.reply_token, user_id, TextSendMessage(text="まだ保存されたデータがありません。"))
             return
 
         result_text = (
@@ -263,17 +606,17 @@ def handle_message(event):
             f"・色: {session.get('color', '未選択')}\n"
             f"・季節: {session.get('season', '未選択')}\n"
             f"・予算: {session.get('budget', '未選択')}\n"
-            f"・住所: {session.get('address', '未送信')}\n"
+            f"・住所: {session.get('area', session.get('address', '未送信'))}\n"
         )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=result_text))
+        outbox.reply(event.reply_token, user_id, TextSendMessage(text=result_text))
         return
 
     # -------------------------
     # どれにも当てはまらない入力
     # -------------------------
     else:
-        line_bot_api.reply_message(
-            event.reply_token,
+        outbox.reply(
+            event.reply_token, user_id,
             TextSendMessage(text="すみません、その入力は処理できません。メニューから選び直すか「テキストから生成」を押してください。")
         )
         return
@@ -285,155 +628,95 @@ def handle_message(event):
 @handler.add(MessageEvent, message=LocationMessage)
 def handle_location(event):
     user_id = event.source.user_id
-    address = event.message.address
-
-    save_session(user_id, "address", address)
-    session = get_session(user_id)
 
-    # Gemini
-    prompt = f"""
-以下の条件から、実用的で真似しやすいコーデを1つ提案してください。
-
-【条件】
-- 性別: {session.get('gender', 'メンズ')}
-- 年齢: {session.get('age', '20代')}
-- 系統: {session.get('category', 'カジュアル')}
-- 色: {session.get('color', '白')}
-- 季節: {session.get('season', '春')}
-- 予算: {session.get('budget', '普通')}
-- 行く場所: {address}
-"""
-
-    ai_text = gemini_model.generate_content(prompt).text
+    # 生の住所ではなく、地域・気候・街の種類のバケットで扱う
+    bucket = location_bucket.classify(
+        event.message.latitude, event.message.longitude, event.message.address
+    )
+    area = bucket.label
+
+    save_session(user_id, "area", area)
+    session = get_session(user_id, consistent=True)
+
+    # Gemini（先読み案があれば手直しだけ）
+    draft = take_speculative_draft(user_id, session)
+    if draft is None:
+        try:
+            ai_text = prompts.generate("coordinate", **coordinate_values(session, area)).text
+        except prompts.TruncatedResponseError as e:
+            # 文章が返らなくても、検索リンクだけは返信する
+            print(f"coordinate error: {e}")
+            ai_text = FALLBACK_COORDINATE_TEXT
+    elif SPECULATIVE_REFINE:
+        try:
+            ai_text = prompts.generate("refine", place=area, draft=draft).text
+        except Exception as e:
+            print(f"refine error: {e}")
+            ai_text = draft
+    else:
+        ai_text = draft
     keywords = build_keywords(session)
 
     # ======================
     # Flex Message
     # ======================
-    flex_content = {
-        "type": "bubble",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "spacing": "md",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": "👕 おすすめコーデ",
-                    "weight": "bold",
-                    "size": "lg"
-                },
-                {
-                    "type": "text",
-                    "text": ai_text,
-                    "wrap": True,
-                    "size": "sm"
-                },
-                {
-                    "type": "separator"
-                },
-                {
-                    "type": "button",
-                    "style": "primary",
-                    "action": {
-                        "type": "uri",
-                        "label": "🛒 トップスをAmazonで見る",
-                        "uri": amazon_search(keywords["tops"])
-                    }
-                },
-                {
-                    "type": "button",
-                    "style": "primary",
-                    "action": {
-                        "type": "uri",
-                        "label": "🛒 ボトムスをAmazonで見る",
-                        "uri": amazon_search(keywords["bottoms"])
-                    }
-                },
-                {
-                    "type": "button",
-                    "style": "primary",
-                    "action": {
-                        "type": "uri",
-                        "label": "🛒 靴をAmazonで見る",
-                        "uri": amazon_search(keywords["shoes"])
-                    }
-                }
-            ]
-        }
-    }
-
-    line_bot_api.reply_message(
-        event.reply_token,
-        FlexSendMessage(
-            alt_text="おすすめコーデ（Amazonリンク）",
-            contents=flex_content
+    outbox.reply(
+        event.reply_token, user_id,
+        COORDINATE_FLEX.render(
+            ai_text=ai_text,
+            tops=amazon_search(keywords["tops"]),
+            bottoms=amazon_search(keywords["bottoms"]),
+            shoes=amazon_search(keywords["shoes"])
         )
     )
 # -------------------------------
 # 画像メッセージ受信時の処理
 # -------------------------------
-@handler.add(MessageEvent, message=ImageMessage)
-def handle_image(event: MessageEvent):
-    user_id = event.source.user_id
-    session = get_session(user_id)
-
+def analyze_image(message_id: str):
+    """
+    画像を取得して、配色解析と（必要なら）Rekognition を行う。
+    (image, palette, labels) を返す。画像セットでは並列に呼ばれる。
+    """
     # -------------------------
     # LINEから画像取得
     # -------------------------
-    message_id = event.message.id
-    message_content = line_bot_api.get_message_content(message_id)
-    image_bytes = message_content.content
+    image = download_image(line_bot_api, message_id)
 
     # -------------------------
-    # Rekognitionでラベル検出
+    # 配色解析（ローカル・通信なし）
     # -------------------------
-    rekog_res = rekognition.detect_labels(
-        Image={"Bytes": image_bytes},
-        MaxLabels=5,
-        MinConfidence=70
-    )
-    labels = [label["Name"] for label in rekog_res["Labels"]]
+    palette = None
+    if color_palette is not None:
+        try:
+            palette = color_palette.extract_palette(image.open())
+        except Exception as e:
+            print(f"palette error: {e}")
 
     # -------------------------
-    # Gemini Vision（解析のみ）
+    # Rekognitionでラベル検出（配色解析で足りない時だけ）
     # -------------------------
-    prompt = f"""
-以下の画像解析結果から、
-その服に似合うコーデを1つ提案してください。
-
-【画像ラベル】
-{labels}
-
-【要件】
-- トップス・ボトムス・靴を具体的に
-- 実用的でシンプル
-- 最後に「JSONのみ」を出力する
-- JSONの前後に説明文や ``` は付けない
-
-【出力ルール】
-・通常の文章
-・最後の行にJSONだけを書く
-
-【JSON例】
-{{
-  "tops": "白シャツ メンズ",
-  "bottoms": "黒 スラックス メンズ",
-  "shoes": "ローファー メンズ"
-}}
-"""
-
-    gemini_res = gemini_model.generate_content(
-        [prompt, {"mime_type": "image/jpeg", "data": image_bytes}]
-    )
+    labels = []
+    if REKOGNITION_MODE == "always" or (
+        REKOGNITION_MODE == "fallback"
+        and (palette is None or palette.confidence < PALETTE_MIN_CONFIDENCE)
+    ):
+        rekog_res = rekognition.detect_labels(
+            Image={"Bytes": image.buffer},
+            MaxLabels=5,
+            MinConfidence=70
+        )
+        labels = [label["Name"] for label in rekog_res["Labels"]]
 
-    raw_text = gemini_res.text
+    return image, palette, labels
 
-    # -------------------------
-    # Gemini出力を分解
-    # -------------------------
+def reply_image_coordinate(reply_token: str, user_id: str, session: dict, raw_text: str):
+    """
+    Gemini の出力（本文＋最後の行のJSON）を分解して Flex で返信する。
+    """
     json_match = re.search(r'\{[\s\S]*\}', raw_text)
     keywords = json.loads(json_match.group()) if json_match else {}
+    # Geminiが返さなかった項目は、セッション（と画像の色）から組み立てる
+    default_keywords = build_keywords(session)
 
     display_text = (
         raw_text.replace(json_match.group(), "").strip()
@@ -441,77 +724,153 @@ def handle_image(event: MessageEvent):
     )
 
     # -------------------------
-    # Flex Message（画像なし）
+    # LINE返信（※1回だけ・画像なし）
     # -------------------------
-    flex_content = {
-        "type": "bubble",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "paddingAll": "12px",
-            "spacing": "sm",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": "📸 画像からのコーデ提案",
-                    "weight": "bold",
-                    "size": "lg"
-                },
-                {
-                    "type": "text",
-                    "text": display_text,
-                    "wrap": True,
-                    "size": "sm"
-                },
-                {"type": "separator"},
-                {
-                    "type": "button",
-                    "style": "primary",
-                    "action": {
-                        "type": "uri",
-                        "label": "🛒 トップスを見る",
-                        "uri": amazon_search(
-                            keywords.get("tops", "メンズ トップス")
-                        )
-                    }
-                },
-                {
-                    "type": "button",
-                    "style": "primary",
-                    "action": {
-                        "type": "uri",
-                        "label": "🛒 ボトムスを見る",
-                        "uri": amazon_search(
-                            keywords.get("bottoms", "メンズ パンツ")
-                        )
-                    }
-                },
-                {
-                    "type": "button",
-                    "style": "primary",
-                    "action": {
-                        "type": "uri",
-                        "label": "🛒 靴を見る",
-                        "uri": amazon_search(
-                            keywords.get("shoes", "メンズ シューズ")
-                        )
-                    }
-                }
-            ]
-        }
-    }
+    outbox.reply(
+        reply_token, user_id,
+        IMAGE_COORDINATE_FLEX.render(
+            ai_text=display_text,
+            tops=amazon_search(keywords.get("tops", default_keywords["tops"])),
+            bottoms=amazon_search(keywords.get("bottoms", default_keywords["bottoms"])),
+            shoes=amazon_search(keywords.get("shoes", default_keywords["shoes"]))
+        )
+    )
+
+@handler.add(MessageEvent, message=ImageMessage)
+def handle_image(event: MessageEvent):
+    user_id = event.source.user_id
+
+    # 複数枚まとめて送られた画像は、lambda_handler の最後に1回でまとめて処理する
+    ref = image_set_of(event.message)
+    if ref is not None and ref.total > 1:
+        image_sets.add(user_id, event.reply_token, ref, event.message.id)
+        return
+
+    session = get_session(user_id)
+    image, palette, labels = analyze_image(event.message.id)
+
+    # 色が未選択なら画像のトーンを検索キーワードに使う
+    if palette is not None:
+        session.setdefault("color", palette.tone)
 
     # -------------------------
-    # LINE返信（※1回だけ）
+    # Gemini Vision（解析のみ）
     # -------------------------
-    line_bot_api.reply_message(
-        event.reply_token,
-        FlexSendMessage(
-            alt_text="画像からおすすめコーデ（Amazon）",
-            contents=flex_content
-        )
+    try:
+        raw_text = prompts.generate(
+            "image_coordinate",
+            {"mime_type": image.content_type, "data": image.tobytes()},
+            labels=", ".join(labels) or "なし",
+            colors=color_palette.describe(palette) if palette else "色: 不明"
+        ).text
+    except prompts.TruncatedResponseError as e:
+        # JSON が無いので、リンクはセッション（と画像の色）から組み立てられる
+        print(f"image_coordinate error: {e}")
+        raw_text = FALLBACK_COORDINATE_TEXT
+    reply_image_coordinate(event.reply_token, user_id, session, raw_text)
+
+def process_image_set(user_id: str, reply_token: str, message_ids: list):
+    """
+    画像セットをまとめて処理する（image_sets.collect から呼ばれる）。
+    - ダウンロードと解析は並列
+    - Gemini には全部の画像を1回で渡し、返信も1通だけ
+    """
+    session = get_session(user_id)
+    workers = max(1, min(IMAGE_SET_WORKERS, len(message_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(analyze_image, message_ids))
+
+    palettes = [palette for _, palette, _ in results if palette is not None]
+    if palettes:
+        session.setdefault("color", palettes[0].tone)
+    labels = sorted({label for _, _, image_labels in results for label in image_labels})
+    colors = "\n".join(
+        f"画像{i} {color_palette.describe(palette)}"
+        for i, (_, palette, _) in enumerate(results, 1) if palette is not None
+    )
+
+    try:
+        raw_text = prompts.generate(
+            "image_set_coordinate",
+            *[{"mime_type": image.content_type, "data": image.tobytes()} for image, _, _ in results],
+            count=len(results),
+            labels=", ".join(labels) or "なし",
+            colors=colors or "色: 不明"
+        ).text
+    except prompts.TruncatedResponseError as e:
+        print(f"image_set_coordinate error: {e}")
+        raw_text = FALLBACK_COORDINATE_TEXT
+    reply_image_coordinate(reply_token, user_id, session, raw_text)
+
+
+# -------------------------------
+# ウォームアップ
+# -------------------------------
+def is_warmup_event(event) -> bool:
+    """
+    ウォームアップ用の呼び出しかどうか。
+    - {"warmup": true} を直接渡した場合
+    - EventBridge のスケジュール実行（source が aws.events）の場合
+    """
+    return bool(event.get("warmup")) or (
+        event.get("source") == "aws.events"
+        and event.get("detail-type") == "Scheduled Event"
     )
 
+def _warmup_steps():
+    """
+    (名前, 通信するか, 処理) の一覧。
+    """
+    steps = [
+        # LINE: Session に TLS 接続を張っておく
+        ("line", True, lambda: line_bot_api.get_bot_info()),
+        # Gemini: 軽い API でクライアントと接続を初期化
+        ("gemini", True, lambda: prompts.get_model("coordinate").count_tokens("warm up")),
+        # DynamoDB: 実際の処理と同じ権限で読める存在しないキー
+        ("dynamodb", True, lambda: table.get_item(Key={"id": "__warmup__"})),
+        ("s3", True, lambda: s3.head_bucket(Bucket=S3_BUCKET)),
+        # Rekognition は軽い API が無いので、クライアント生成（import時）のみ
+        ("flex_templates", False, lambda: COORDINATE_FLEX.render(
+            ai_text="warm up", tops="https://", bottoms="https://", shoes="https://"
+        )),
+        ("location_bucket", False, lambda: location_bucket.classify(35.690, 139.692)),
+        ("prompts", False, lambda: [
+            prompts.get_model(name)
+            for name in ("coordinate", "refine", "image_coordinate", "image_set_coordinate")
+        ]),
+    ]
+    if color_palette is not None:
+        from PIL import Image
+        steps.append((
+            "color_palette", False,
+            lambda: color_palette.extract_palette(Image.new("RGB", (8, 8), "white"))
+        ))
+    return steps
+
+def warm_up(dry_run: bool = False) -> dict:
+    """
+    クライアント・接続・静的テーブルを準備し、各ステップの所要時間(ms)を返す。
+    - dry_run では通信するステップを飛ばす（ローカルでの動作確認用）
+    - 失敗したステップがあっても残りは続ける
+    """
+    report = {}
+    for name, network, step in _warmup_steps():
+        if dry_run and network:
+            report[name] = {"status": "skipped"}
+            continue
+        start = time.perf_counter()
+        try:
+            step()
+            status = "ok"
+        except Exception as e:
+            status = f"error: {e}"
+        report[name] = {
+            "status": status,
+            "ms": round((time.perf_counter() - start) * 1000, 1)
+        }
+    print(f"warm up: {json.dumps(report, ensure_ascii=False)}")
+    return report
+
 
 # -------------------------------
 # Lambda関数のエントリポイント
@@ -520,9 +879,24 @@ def lambda_handler(event, context):
     """
     AWS Lambda用エントリポイント
     LINEのWebhookイベントを処理
+    （ウォームアップ用の呼び出しでは handler.handle を通さない）
     """
-    handler.handle(
-        event['body'],
-        event['headers']['x-line-signature']
-    )
+    if is_warmup_event(event):
+        report = warm_up(dry_run=bool(event.get("dry_run")))
+        # このコンテナで呼び出した Gemini のテンプレートごとの集計も返す
+        body = {"warmup": report, "prompts": prompts.report()}
+        return {'statusCode': 200, 'body': json.dumps(body, ensure_ascii=False)}
+
+    try:
+        handler.handle(
+            event['body'],
+            event['headers']['x-line-signature']
+        )
+    finally:
+        try:
+            # 画像セットは揃うのを待ってから（担当になった場合だけ）まとめて返信
+            image_sets.collect(process_image_set)
+        finally:
+            outbox.flush()
+            wait_speculative_drafts()
     return {'statusCode': 200, 'body': 'OK'}
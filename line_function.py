@@ -2,10 +2,14 @@ import os
 import boto3
 import google.generativeai as genai
 import pickle
-from linebot import LineBotApi, WebhookHandler
+from linebot import LineBotApi
 from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageMessage
+from image_download import download_image
+from outbox import Outbox
+from webhook_ingest import Ingestor
 line_bot_api = LineBotApi(os.environ.get('CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.environ.get('CHANNEL_SECRET'))
+handler = Ingestor(os.environ.get('CHANNEL_SECRET'))
+outbox = Outbox(line_bot_api)
 genai.configure(api_key=os.environ.get('GOOGLE_API_KEY'))
 gemini_model = genai.GenerativeModel("gemini-2.5-flash")
 
@@ -52,8 +56,8 @@ def handle_text_message(event: MessageEvent):
         #response = gemini_model.generate_content([prompt])
         message = response.text.rstrip('\n')
         putItemToDynamoDB(userID, 0, pickle.dumps(chat.history))
-    line_bot_api.reply_message(
-            event.reply_token,
+    outbox.reply(
+            event.reply_token, userID,
             TextSendMessage(text=message))
 
 @handler.add(MessageEvent, message=ImageMessage)
@@ -66,12 +70,10 @@ def handle_image_message(event: MessageEvent):
         item = getItemFromDynamoDB(userID)
     putItemToDynamoDB(userID, item['val']+1, item['chat'])
     retrun_message = str(item['val']+1) + "回目の画像投稿です。\n"
-    message_id = event.message.id
-    message_content = line_bot_api.get_message_content(message_id)
-    message_binary = message_content.content
+    image = download_image(line_bot_api, event.message.id)
     detect = rekognition.detect_labels(
         Image={
-            "Bytes": message_binary
+            "Bytes": image.buffer
         }
     )
     labels = detect['Labels']
@@ -79,7 +81,7 @@ def handle_image_message(event: MessageEvent):
     if ("Human" in names or "Person" in names):
         response = rekognition.recognize_celebrities(
             Image={
-                "Bytes": message_binary
+                "Bytes": image.buffer
             }
         )
         if (len(response['CelebrityFaces']) > 0):
@@ -90,12 +92,15 @@ def handle_image_message(event: MessageEvent):
             retrun_message += "有名人を特定できませんでした！"
     else:
         retrun_message += "人物を検出できませんでした！"
-    line_bot_api.reply_message(
-            event.reply_token,
+    outbox.reply(
+            event.reply_token, userID,
             TextSendMessage(text=retrun_message))
 
 def lambda_handler(event, context):
-    handler.handle(
-        event['body'],
-        event['headers']['x-line-signature'])
+    try:
+        handler.handle(
+            event['body'],
+            event['headers']['x-line-signature'])
+    finally:
+        outbox.flush()
     return {'statusCode': 200, 'body': 'OK'}
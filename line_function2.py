@@ -1,18 +1,31 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 import google.generativeai as genai
-from linebot import LineBotApi, WebhookHandler
+from linebot import LineBotApi
 from linebot.models import (
-    MessageEvent, TextMessage, TextSendMessage, ImageMessage,
-    TemplateSendMessage, ButtonsTemplate, MessageAction
+    TextSendMessage, TemplateSendMessage, ButtonsTemplate, MessageAction
+)
+from image_download import download_image
+from image_set import ImageSetAggregator, image_set_of
+from outbox import Outbox
+from webhook_ingest import Ingestor
+import prompts
+from recommendation_table import (
+    RECOMMENDED_ITEMS, PRICE_OPTIONS, RecommendationTable,
+    GeminiRecommendationClient, build_recommendation_prompt
 )
 
 # === LINE設定 ===
 LINE_CHANNEL_ACCESS_TOKEN = os.environ['LINE_CHANNEL_ACCESS_TOKEN']
 LINE_CHANNEL_SECRET = os.environ['LINE_CHANNEL_SECRET']
 line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+handler = Ingestor(LINE_CHANNEL_SECRET)
+# 処理するイベントの種類（それ以外は dict のまま捨てる）
+SUPPORTED_EVENTS = {('message', 'image'), ('message', 'text')}
+# 送信はここに溜めて、lambda_handler の最後にまとめて送る
+outbox = Outbox(line_bot_api)
 
 # === Gemini設定 ===
 genai.configure(api_key=os.environ['GOOGLE_API_KEY'])
@@ -22,78 +35,160 @@ dynamodb = boto3.resource('dynamodb')
 table_images = dynamodb.Table('UserImages')
 table_selections = dynamodb.Table('UserSelections')
 
+# === S3設定 ===
+# 画像（最大 10 MiB）は DynamoDB の項目上限 400 KB を超えるので S3 に置き、
+# UserImages にはキーとハッシュだけを保存する
+s3 = boto3.client('s3')
+S3_BUCKET = os.environ['S3_BUCKET']
+
+# 複数枚まとめて送られた画像は UserImages に imageId="imageset:{id}" で集め、1回で解析する
+image_sets = ImageSetAggregator(
+    table_images, key=lambda user_id, set_id: {'userId': user_id, 'imageId': f'imageset:{set_id}'}
+)
+IMAGE_SET_WORKERS = int(os.environ.get('IMAGE_SET_WORKERS', '4'))
+
+# === 事前計算したおすすめテーブル ===
+# recommendation_table.py で生成したものを起動時に読み込み、定期的に更新を取り込む
+recommendations = RecommendationTable(
+    os.environ.get('RECOMMENDATION_TABLE', 'recommendations.json')
+)
+recommendations.start_refresh(int(os.environ.get('RECOMMENDATION_REFRESH_SECONDS', '300')))
+recommendation_client = GeminiRecommendationClient()
+
 # === Lambda本体 ===
 def lambda_handler(event, context):
-    body = json.loads(event['body'])
-    
-    for ev in body['events']:
-        user_id = ev['source']['userId']
+    # 署名を検証してから、対象のイベントだけを取り出す
+    events = handler.parse(
+        event['body'], event['headers']['x-line-signature'], SUPPORTED_EVENTS
+    )
+
+    try:
+        for ev in events:
+            user_id = ev['source']['userId']
+            # 返信トークンがあれば push より優先して使う
+            outbox.add_reply_token(user_id, ev.get('replyToken'))
         
-        # 1️⃣ 画像受信
-        if ev['type'] == 'message' and ev['message']['type'] == 'image':
-            message_id = ev['message']['id']
-            image_content = line_bot_api.get_message_content(message_id)
-            image_bytes = image_content.content
-            
-            # DynamoDBに一時保存
-            table_images.put_item(Item={
-                'userId': user_id,
-                'imageId': message_id,
-                'imageData': image_bytes.hex(),
-                'status': 'received'
-            })
+            # 1️⃣ 画像受信
+            if ev['type'] == 'message' and ev['message']['type'] == 'image':
+                message_id = ev['message']['id']
+
+                # 画像セットは最後にまとめて処理する
+                ref = image_set_of(ev['message'])
+                if ref is not None and ref.total > 1:
+                    image_sets.add(user_id, ev.get('replyToken'), ref, message_id)
+                    continue
+
+                image = store_image(user_id, message_id)
             
-            # Geminiで解析
-            analysis_result = analyze_image(image_bytes)
-            table_images.update_item(
-                Key={'userId': user_id, 'imageId': message_id},
-                UpdateExpression="SET status=:s, analysisResult=:r",
-                ExpressionAttributeValues={
-                    ':s': 'analyzed',
-                    ':r': analysis_result
-                }
-            )
+                # Geminiで解析
+                analysis_result = analyze_image(image.tobytes())
+                save_analysis(user_id, message_id, analysis_result)
             
-            # ユーザーに確認
-            send_clothing_confirmation(user_id, analysis_result['type'])
+                # ユーザーに確認
+                send_clothing_confirmation(user_id, analysis_result['type'])
         
-        # 2️⃣ 服タイプ確認・アイテム選択・価格選択の応答
-        elif ev['type'] == 'message' and ev['message']['type'] == 'text':
-            text = ev['message']['text']
+            # 2️⃣ 服タイプ確認・アイテム選択・価格選択の応答
+            elif ev['type'] == 'message' and ev['message']['type'] == 'text':
+                text = ev['message']['text']
             
-            # 服タイプ確認
-            if text.startswith('服タイプ確認:'):
-                send_item_suggestions(user_id)
+                # 服タイプ確認
+                if text.startswith('服タイプ確認:'):
+                    send_item_suggestions(user_id)
             
-            # アイテム選択
-            elif text.startswith('アイテム選択:'):
-                selected_item = text.split(':')[1]
-                table_selections.put_item(Item={
-                    'userId': user_id,
-                    'selectedItem': selected_item
-                })
-                ask_price_range(user_id)
+                # アイテム選択
+                elif text.startswith('アイテム選択:'):
+                    selected_item = text.split(':')[1]
+                    table_selections.put_item(Item={
+                        'userId': user_id,
+                        'selectedItem': selected_item
+                    })
+                    ask_price_range(user_id)
             
-            # 価格選択
-            elif text.startswith('価格帯選択:'):
-                price_range = text.split(':')[1]
-                selected_item = table_selections.get_item(Key={'userId': user_id})['Item']['selectedItem']
-                generate_final_recommendation(user_id, selected_item, price_range)
-    
+                # 価格選択
+                elif text.startswith('価格帯選択:'):
+                    price_range = text.split(':')[1]
+                    selected_item = table_selections.get_item(Key={'userId': user_id})['Item']['selectedItem']
+                    generate_final_recommendation(user_id, selected_item, price_range)
+
+        # 画像セットは揃うのを待ってから（担当になった場合だけ）まとめて解析
+        image_sets.collect(process_image_set)
+    finally:
+        outbox.flush()
     return {'statusCode': 200}
 
 
 # === Geminiで服解析 ===
 def analyze_image(image_bytes):
-    response = genai.generate_content(
-        model="gemini-2.0-flash",
-        prompt="Analyze this clothing item and return type, color, pattern in JSON format.",
-        image=image_bytes
+    response = prompts.generate(
+        "clothing_analysis", {"mime_type": "image/jpeg", "data": image_bytes}
     )
-    result = response.content  # JSON形式で返す想定
+    result = json.loads(response.text)  # response_mime_type で JSON を指定済み
     return result
 
 
+def analyze_images(images):
+    """
+    複数枚を1回の呼び出しで解析し、画像の順に結果のリストを返す。
+    """
+    response = prompts.generate(
+        "clothing_set_analysis",
+        *[{"mime_type": "image/jpeg", "data": image.tobytes()} for image in images],
+        count=len(images)
+    )
+    results = json.loads(response.text)
+    if not isinstance(results, list) or len(results) != len(images):
+        raise ValueError(f"解析結果の件数が画像の枚数と合いません: {response.text[:100]}")
+    return results
+
+
+# === 画像の保存 ===
+def store_image(user_id, message_id):
+    image = download_image(line_bot_api, message_id)
+
+    # 本体は S3 へ（同じ画像は同じキーになる）
+    image_key = f"images/{user_id}/{image.sha256}"
+    s3.put_object(
+        Bucket=S3_BUCKET, Key=image_key, Body=image.buffer, ContentType=image.content_type
+    )
+    table_images.put_item(Item={
+        'userId': user_id,
+        'imageId': message_id,
+        'imageKey': image_key,
+        'imageHash': image.sha256,
+        'status': 'received'
+    })
+    return image
+
+
+def save_analysis(user_id, message_id, analysis_result):
+    table_images.update_item(
+        Key={'userId': user_id, 'imageId': message_id},
+        # status は DynamoDB の予約語
+        UpdateExpression="SET #s = :s, analysisResult = :r",
+        ExpressionAttributeNames={'#s': 'status'},
+        ExpressionAttributeValues={
+            ':s': 'analyzed',
+            ':r': analysis_result
+        }
+    )
+
+
+# === 画像セットの処理（image_sets.collect から呼ばれる） ===
+def process_image_set(user_id, reply_token, message_ids):
+    # 返信トークンはイベントの受信時に outbox へ登録済み
+    workers = max(1, min(IMAGE_SET_WORKERS, len(message_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        images = list(pool.map(lambda message_id: store_image(user_id, message_id), message_ids))
+
+    results = analyze_images(images)
+    for message_id, analysis_result in zip(message_ids, results):
+        save_analysis(user_id, message_id, analysis_result)
+
+    # 確認は1通だけ（ボタンの本文は60文字まで）
+    types = "・".join(dict.fromkeys(r.get('type', '?') for r in results))
+    send_clothing_confirmation(user_id, types[:40])
+
+
 # === LINEで服確認 ===
 def send_clothing_confirmation(user_id, clothing_type):
     buttons_template = ButtonsTemplate(
@@ -104,43 +199,41 @@ def send_clothing_confirmation(user_id, clothing_type):
             MessageAction(label='いいえ', text='服タイプ確認:いいえ')
         ]
     )
-    line_bot_api.push_message(user_id, TemplateSendMessage(alt_text='服の確認', template=buttons_template))
+    outbox.push(user_id, TemplateSendMessage(alt_text='服の確認', template=buttons_template))
 
 
 # === 類似アイテム提案 ===
 def send_item_suggestions(user_id):
-    recommended_items = ["デニムパンツ", "カーゴパンツ", "スカート"]
+    recommended_items = RECOMMENDED_ITEMS
     buttons_template = ButtonsTemplate(
         title="似合うアイテム",
         text="以下の中から選んでください",
         actions=[MessageAction(label=item, text=f"アイテム選択:{item}") for item in recommended_items]
     )
-    line_bot_api.push_message(user_id, TemplateSendMessage(alt_text='似合うアイテム', template=buttons_template))
+    outbox.push(user_id, TemplateSendMessage(alt_text='似合うアイテム', template=buttons_template))
 
 
 # === 価格帯選択 ===
 def ask_price_range(user_id):
-    price_options = [
-        "1000~3000円",
-        "3000~5000円",
-        "5000~10000円",
-        "10000円以上"
-    ]
+    price_options = PRICE_OPTIONS
     buttons_template = ButtonsTemplate(
         title="価格帯を選択",
         text="希望の価格帯を選んでください",
         actions=[MessageAction(label=p, text=f"価格帯選択:{p}") for p in price_options]
     )
-    line_bot_api.push_message(user_id, TemplateSendMessage(alt_text='価格帯選択', template=buttons_template))
+    outbox.push(user_id, TemplateSendMessage(alt_text='価格帯選択', template=buttons_template))
 
 
 # === 最終おすすめ生成 ===
 def generate_final_recommendation(user_id, selected_item, price_range):
-    prompt = f"ユーザーが選んだ服:{selected_item}, 価格帯:{price_range}. おすすめの服と購入サイトをJSONで返して。"
-    response = genai.generate_content(model="gemini-2.0-flash", prompt=prompt)
-    recommendation = response.content  # JSON形式想定
+    # 事前計算済みなら辞書引きだけ、なければライブ生成
+    recommendation = recommendations.lookup(selected_item, price_range)
+    if recommendation is None:
+        recommendation = recommendation_client(
+            build_recommendation_prompt(selected_item, price_range)
+        )
     
-    line_bot_api.push_message(
+    outbox.push(
         user_id,
         TextSendMessage(
             text=f"おすすめ: {recommendation['item_name']} ({recommendation['price']})\n購入サイト: {recommendation['site_url']}"
@@ -0,0 +1,279 @@
+# ================================
+# 位置情報のざっくり分類
+# ================================
+"""
+LocationMessage の緯度経度・住所を、地域／気候／街の種類の
+少数のバケットに分類する（ネットワーク通信なし・メモリ上のみ）。
+
+プロンプトやキャッシュ、集計は生の住所ではなくバケットをキーにする。
+
+    bucket = classify(35.658, 139.701, "日本、〒150-0002 東京都渋谷区渋谷２丁目")
+    bucket.label  # => "関東・都市部（太平洋側の気候）"
+"""
+import math
+from collections import namedtuple
+
+LocationBucket = namedtuple("LocationBucket", ["key", "region", "climate", "venue", "label"])
+
+# ================================
+# 同梱テーブル
+# ================================
+# 都道府県名, 地方, 気候区分, 県庁所在地の緯度, 経度
+PREFECTURES = [
+    ("北海道", "北海道", "北海道", 43.064, 141.347),
+    ("青森県", "東北", "日本海側", 40.824, 140.740),
+    ("岩手県", "東北", "太平洋側", 39.704, 141.153),
+    ("宮城県", "東北", "太平洋側", 38.269, 140.872),
+    ("秋田県", "東北", "日本海側", 39.719, 140.102),
+    ("山形県", "東北", "日本海側", 38.240, 140.364),
+    ("福島県", "東北", "内陸", 37.750, 140.468),
+    ("茨城県", "関東", "太平洋側", 36.342, 140.447),
+    ("栃木県", "関東", "太平洋側", 36.566, 139.884),
+    ("群馬県", "関東", "内陸", 36.391, 139.061),
+    ("埼玉県", "関東", "太平洋側", 35.857, 139.649),
+    ("千葉県", "関東", "太平洋側", 35.605, 140.123),
+    ("東京都", "関東", "太平洋側", 35.690, 139.692),
+    ("神奈川県", "関東", "太平洋側", 35.448, 139.643),
+    ("新潟県", "中部", "日本海側", 37.902, 139.023),
+    ("富山県", "中部", "日本海側", 36.695, 137.211),
+    ("石川県", "中部", "日本海側", 36.594, 136.626),
+    ("福井県", "中部", "日本海側", 36.065, 136.222),
+    ("山梨県", "中部", "内陸", 35.664, 138.568),
+    ("長野県", "中部", "内陸", 36.651, 138.181),
+    ("岐阜県", "中部", "内陸", 35.391, 136.722),
+    ("静岡県", "中部", "太平洋側", 34.977, 138.383),
+    ("愛知県", "中部", "太平洋側", 35.180, 136.907),
+    ("三重県", "近畿", "太平洋側", 34.730, 136.509),
+    ("滋賀県", "近畿", "内陸", 35.004, 135.868),
+    ("京都府", "近畿", "内陸", 35.021, 135.756),
+    ("大阪府", "近畿", "瀬戸内", 34.686, 135.520),
+    ("兵庫県", "近畿", "瀬戸内", 34.691, 135.183),
+    ("奈良県", "近畿", "内陸", 34.686, 135.833),
+    ("和歌山県", "近畿", "太平洋側", 34.226, 135.168),
+    ("鳥取県", "中国", "日本海側", 35.504, 134.238),
+    ("島根県", "中国", "日本海側", 35.472, 133.051),
+    ("岡山県", "中国", "瀬戸内", 34.662, 133.935),
+    ("広島県", "中国", "瀬戸内", 34.397, 132.460),
+    ("山口県", "中国", "瀬戸内", 34.186, 131.471),
+    ("徳島県", "四国", "瀬戸内", 34.066, 134.559),
+    ("香川県", "四国", "瀬戸内", 34.340, 134.043),
+    ("愛媛県", "四国", "瀬戸内", 33.842, 132.766),
+    ("高知県", "四国", "太平洋側", 33.560, 133.531),
+    ("福岡県", "九州・沖縄", "日本海側", 33.607, 130.418),
+    ("佐賀県", "九州・沖縄", "太平洋側", 33.249, 130.299),
+    ("長崎県", "九州・沖縄", "太平洋側", 32.745, 129.874),
+    ("熊本県", "九州・沖縄", "太平洋側", 32.790, 130.742),
+    ("大分県", "九州・沖縄", "瀬戸内", 33.238, 131.613),
+    ("宮崎県", "九州・沖縄", "太平洋側", 31.911, 131.424),
+    ("鹿児島県", "九州・沖縄", "太平洋側", 31.560, 130.558),
+    ("沖縄県", "九州・沖縄", "南西諸島", 26.212, 127.681),
+]
+
+# 都市部とみなす市（政令指定都市）と東京23区, 中心の緯度, 経度
+CITIES = [
+    ("札幌市", 43.062, 141.354),
+    ("仙台市", 38.268, 140.870),
+    ("さいたま市", 35.861, 139.646),
+    ("千葉市", 35.607, 140.106),
+    ("東京23区", 35.689, 139.692),
+    ("川崎市", 35.531, 139.703),
+    ("横浜市", 35.444, 139.638),
+    ("相模原市", 35.571, 139.373),
+    ("新潟市", 37.916, 139.036),
+    ("静岡市", 34.975, 138.383),
+    ("浜松市", 34.711, 137.726),
+    ("名古屋市", 35.181, 136.906),
+    ("京都市", 35.012, 135.768),
+    ("大阪市", 34.694, 135.502),
+    ("堺市", 34.573, 135.483),
+    ("神戸市", 34.690, 135.196),
+    ("岡山市", 34.655, 133.919),
+    ("広島市", 34.385, 132.455),
+    ("北九州市", 33.883, 130.875),
+    ("福岡市", 33.590, 130.402),
+    ("熊本市", 32.803, 130.708),
+]
+
+URBAN_RADIUS_KM = 15
+
+# 日本の範囲を囲む多角形（緯度, 経度）。住所に都道府県名が無い時の国内外の判定に使う。
+# 離島（対馬・五島・先島諸島・大東諸島・小笠原・北方領土・礼文）を含み、
+# 朝鮮半島・済州島・鬱陵島・台湾・サハリン・沿海州を含まないように引いてある。
+JAPAN_BOUNDARY = [
+    (23.8, 125.0), (23.9, 123.5), (24.2, 122.6), (24.8, 122.6),   # 先島諸島（台湾の東）
+    (26.0, 123.3), (30.0, 127.5), (32.0, 128.0), (33.2, 128.3),   # 東シナ海（済州島の東）
+    (34.0, 128.9), (34.75, 129.2), (35.0, 129.6),                 # 対馬と朝鮮半島の間
+    (36.0, 131.5), (38.0, 134.5), (40.5, 138.5), (42.5, 139.0),   # 日本海（鬱陵島・沿海州の東）
+    (45.0, 140.6), (45.7, 140.9), (45.7, 142.1),                  # 礼文・宗谷（サハリンの南）
+    (44.6, 145.0), (45.8, 148.9), (44.0, 150.0),                  # 知床・北方領土
+    (42.0, 145.5), (40.0, 143.5), (35.5, 141.8), (34.0, 142.0),   # 太平洋
+    (27.5, 143.0), (24.0, 142.0), (24.0, 140.5),                  # 小笠原
+    (25.3, 131.0),                                                # 大東諸島の南
+]
+
+URBAN = "都市部"
+SUBURBAN = "郊外・地方"
+
+UNKNOWN = LocationBucket("unknown", "不明", "不明", "不明", "不明")
+OVERSEAS = LocationBucket("overseas", "海外", "不明", "不明", "海外・その他")
+
+# ================================
+# ジオハッシュ索引
+# ================================
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 3   # 1セル約156km四方
+
+
+def geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        rng, value = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def _cell_size(precision):
+    lon_bits = (precision * 5 + 1) // 2
+    lat_bits = precision * 5 // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def _neighborhood(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    自セルと周囲8セルのジオハッシュ。
+    """
+    dlat, dlon = _cell_size(precision)
+    cells = set()
+    for i in (-1, 0, 1):
+        for j in (-1, 0, 1):
+            lat = max(-90.0, min(90.0, latitude + i * dlat))
+            lon = (longitude + j * dlon + 180.0) % 360.0 - 180.0
+            cells.add(geohash(lat, lon, precision))
+    return cells
+
+
+def _distance_km(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+
+class _GeoIndex:
+    """
+    (名前, 緯度, 経度, ...) の行をジオハッシュのセルごとに持つ。
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.cells = {}
+        for row in rows:
+            self.cells.setdefault(geohash(row[-2], row[-1]), []).append(row)
+
+    def nearest(self, latitude, longitude):
+        candidates = [
+            row
+            for cell in _neighborhood(latitude, longitude)
+            for row in self.cells.get(cell, [])
+        ]
+        if not candidates:
+            candidates = self.rows
+        best = min(candidates, key=lambda row: _distance_km(latitude, longitude, row[-2], row[-1]))
+        return best, _distance_km(latitude, longitude, best[-2], best[-1])
+
+
+def in_japan(latitude, longitude):
+    """
+    JAPAN_BOUNDARY の内側かどうか（レイキャスティング）。
+    """
+    inside = False
+    n = len(JAPAN_BOUNDARY)
+    for i in range(n):
+        lat1, lon1 = JAPAN_BOUNDARY[i]
+        lat2, lon2 = JAPAN_BOUNDARY[(i + 1) % n]
+        if (lat1 > latitude) != (lat2 > latitude):
+            crossing = lon1 + (latitude - lat1) * (lon2 - lon1) / (lat2 - lat1)
+            if longitude < crossing:
+                inside = not inside
+    return inside
+
+
+_prefecture_index = _GeoIndex(PREFECTURES)
+_city_index = _GeoIndex(CITIES)
+_prefecture_by_name = {row[0]: row for row in PREFECTURES}
+
+# ================================
+# 分類
+# ================================
+def make_bucket(region, climate, venue):
+    return LocationBucket(
+        key=f"{region}|{climate}|{venue}",
+        region=region,
+        climate=climate,
+        venue=venue,
+        label=f"{region}・{venue}（{climate}の気候）"
+    )
+
+
+def _prefecture_from_address(address):
+    if not address:
+        return None
+    for name in _prefecture_by_name:
+        if name in address:
+            return _prefecture_by_name[name]
+    return None
+
+
+def _is_urban_address(prefecture, address):
+    if not address:
+        return False
+    # 住所に「東京都」が無い（英語表記など）場合は、下の都市からの距離で判定する
+    if prefecture == "東京都" and "東京都" in address:
+        after = address.split("東京都", 1)[1]
+        # 23区は「東京都○○区」、市部は「東京都○○市」
+        ku = after.find("区")
+        shi = after.find("市")
+        return ku != -1 and (shi == -1 or ku < shi)
+    return any(city in address for city, _, _ in CITIES)
+
+
+def classify(latitude=None, longitude=None, address=None):
+    """
+    緯度経度・住所からバケットを返す。
+    - 住所に都道府県名があればそれを優先し、なければ日本の範囲内かを見てから
+      最寄りの県庁所在地で判定
+    - どちらも無ければ UNKNOWN
+    """
+    has_point = latitude is not None and longitude is not None
+    prefecture = _prefecture_from_address(address)
+    if prefecture is None:
+        if not has_point:
+            return UNKNOWN
+        if not in_japan(latitude, longitude):
+            return OVERSEAS
+        prefecture, _ = _prefecture_index.nearest(latitude, longitude)
+
+    name, region, climate = prefecture[0], prefecture[1], prefecture[2]
+    urban = _is_urban_address(name, address)
+    if not urban and has_point:
+        _, distance = _city_index.nearest(latitude, longitude)
+        urban = distance <= URBAN_RADIUS_KM
+    return make_bucket(region, climate, URBAN if urban else SUBURBAN)
@@ -0,0 +1,185 @@
+# ================================
+# 送信メッセージのまとめ送り
+# ================================
+"""
+1回の呼び出しの間に作られたメッセージをユーザーごとに溜めておき、
+最後にまとめて送る。
+
+- 1回の reply / push に最大5件まで詰める
+- 無料の reply トークンがあれば push より優先して使う
+- 同じ内容を複数ユーザーへ push する場合は multicast にまとめる
+- 送信は最後に並列で行う
+- 本文は各メッセージのJSONを連結して組み立てる（flex_templates の
+  シリアライズ済みメッセージは再シリアライズしない）
+
+    outbox = Outbox(line_bot_api)
+    outbox.reply(event.reply_token, user_id, TextSendMessage(text="..."))
+    outbox.push(user_id, TemplateSendMessage(...))
+    outbox.flush()   # lambda_handler の最後で呼ぶ
+
+溜めている内容はスレッドごとに分かれているので、
+1スレッドで1呼び出しを処理する限り他の呼び出しと混ざらない。
+"""
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.exceptions import LineBotApiError
+from linebot.models import Error
+
+MAX_MESSAGES_PER_REQUEST = 5
+MAX_MULTICAST_USERS = 500
+
+_ENDPOINTS = {
+    "reply": ("/v2/bot/message/reply", "replyToken"),
+    "push": ("/v2/bot/message/push", "to"),
+    "multicast": ("/v2/bot/message/multicast", "to"),
+}
+
+
+def message_json(message):
+    """
+    送信用のJSON文字列。シリアライズ済みならそのまま使う。
+    """
+    if hasattr(message, "as_json_string"):
+        return message.as_json_string()
+    return json.dumps(message.as_json_dict(), ensure_ascii=False, separators=(",", ":"))
+
+
+class LinePoster:
+    """
+    シリアライズ済みの本文を Messaging API に POST する。
+    LineBotApi の非公開メソッド（_post）には頼らず、公開されている
+    endpoint / headers / http_client（SessionHttpClient など）だけを使う。
+    SDK の変更で壊れる場合はここだけを直せばよい。
+    """
+
+    def __init__(self, line_bot_api):
+        self.endpoint = line_bot_api.endpoint
+        self.headers = dict(line_bot_api.headers, **{"Content-Type": "application/json"})
+        self.http_client = line_bot_api.http_client
+
+    def post(self, path, body):
+        response = self.http_client.post(self.endpoint + path, headers=self.headers, data=body)
+        if not 200 <= response.status_code < 300:
+            # linebot の reply_message などと同じ例外にする
+            raise LineBotApiError(
+                status_code=response.status_code,
+                headers=dict(response.headers.items()),
+                request_id=response.headers.get("X-Line-Request-Id"),
+                accepted_request_id=response.headers.get("X-Line-Accepted-Request-Id"),
+                error=Error.new_from_json_dict(response.json)
+            )
+        return response
+
+
+class Outbox:
+
+    def __init__(self, line_bot_api, max_workers=8):
+        self.line_bot_api = line_bot_api
+        self.poster = LinePoster(line_bot_api)
+        self.max_workers = max_workers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _pending(self):
+        if not hasattr(self._local, "pending"):
+            self._local.pending = {}
+        return self._local.pending
+
+    def _entry(self, user_id):
+        return self._pending().setdefault(user_id, {"tokens": [], "messages": []})
+
+    def add_reply_token(self, user_id, reply_token):
+        if reply_token:
+            self._entry(user_id)["tokens"].append(reply_token)
+
+    def reply(self, reply_token, user_id, messages):
+        """
+        reply_message の代わり。トークンは最後にまとめて使う。
+        """
+        self.add_reply_token(user_id, reply_token)
+        self.push(user_id, messages)
+
+    def push(self, user_id, messages):
+        """
+        push_message の代わり。使えるトークンが残っていれば reply で送られる。
+        """
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        self._entry(user_id)["messages"].extend(messages)
+
+    def _plan(self, pending):
+        """
+        溜まったメッセージを (種類, 宛先, メッセージ) の送信単位に分ける。
+        - 1ユーザー分が複数回に分かれる場合は順番を守るため "sequence" にまとめる
+        """
+        requests = []
+        pushes = {}
+        for user_id, entry in pending.items():
+            tokens = list(entry["tokens"])
+            messages = entry["messages"]
+            encoded = [message_json(m) for m in messages]
+            chunks = [
+                encoded[i:i + MAX_MESSAGES_PER_REQUEST]
+                for i in range(0, len(encoded), MAX_MESSAGES_PER_REQUEST)
+            ]
+            planned = [
+                ("reply", tokens.pop(0), chunk) if tokens else ("push", user_id, chunk)
+                for chunk in chunks
+            ]
+            if len(planned) > 1:
+                requests.append(("sequence", None, planned))
+            elif planned and planned[0][0] == "push":
+                chunk = planned[0][2]
+                pushes.setdefault(",".join(chunk), (chunk, []))[1].append(user_id)
+            else:
+                requests.extend(planned)
+
+        for chunk, user_ids in pushes.values():
+            if len(user_ids) == 1:
+                requests.append(("push", user_ids[0], chunk))
+                continue
+            for i in range(0, len(user_ids), MAX_MULTICAST_USERS):
+                requests.append(("multicast", user_ids[i:i + MAX_MULTICAST_USERS], chunk))
+        return requests
+
+    def _send(self, request):
+        kind, to, messages = request
+        if kind == "sequence":
+            for sub_request in messages:
+                self._send(sub_request)
+            return
+        path, to_field = _ENDPOINTS[kind]
+        body = '{%s:%s,"messages":[%s]}' % (
+            json.dumps(to_field), json.dumps(to), ",".join(messages)
+        )
+        self.poster.post(path, body.encode("utf-8"))
+
+    def flush(self):
+        """
+        溜まったメッセージを最小回数のAPI呼び出しで並列に送る。
+        送信に失敗したものはログに出して続行する。
+        """
+        pending = self._pending()
+        self._local.pending = {}
+        requests = self._plan(pending)
+        if not requests:
+            return 0
+        if len(requests) == 1:
+            results = [self._safe_send(requests[0])]
+        else:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            results = list(self._executor.map(self._safe_send, requests))
+        return sum(results)
+
+    def _safe_send(self, request):
+        try:
+            self._send(request)
+            return 1
+        except Exception as e:
+            print(f"outbox {request[0]} error: {e}")
+            return 0
@@ -0,0 +1,262 @@
+# ================================
+# Gemini プロンプト登録簿
+# ================================
+"""
+すべての Gemini 呼び出しのプロンプトをここに集める。
+
+- 共通のペルソナは system_instruction として1回だけ渡す
+- 各テンプレートは条件だけを短く書き、出力トークン数と温度を個別に決める
+- 呼び出しごとに入出力トークン数と所要時間を記録し、report() で集計を返す
+  （line_function-try のウォームアップ応答にも含まれる）
+- 思考トークンで出力上限に達した（finish_reason が MAX_TOKENS）場合は、
+  上限を広げて1回だけ呼び直す
+
+    text = prompts.generate("coordinate", gender="男性", ...).text
+    prompts.generate("image_coordinate", image_part, labels=..., colors=...)
+
+テンプレートごとの入力トークン数の一覧:
+    python prompts.py
+"""
+import os
+import time
+import threading
+from collections import namedtuple
+
+import google.generativeai as genai
+
+PERSONA = (
+    "あなたはプロのファッションスタイリストです。"
+    "日本語で、実在しそうな具体的なアイテム名を挙げ、前置きや繰り返しなしで簡潔に答えてください。"
+)
+
+# 2.5 系は思考トークンも max_output_tokens に含まれるため、その分を上乗せする
+THINKING_HEADROOM = int(os.environ.get('GEMINI_THINKING_HEADROOM', '1024'))
+# MAX_TOKENS で打ち切られた時に呼び直す際の上限の倍率
+MAX_TOKENS_RETRY_FACTOR = int(os.environ.get('GEMINI_MAX_TOKENS_RETRY_FACTOR', '3'))
+
+PromptTemplate = namedtuple(
+    "PromptTemplate",
+    ["model_name", "text", "max_output_tokens", "temperature", "response_mime_type"]
+)
+
+TEMPLATES = {
+    # line_function-try: ウィザードの条件からコーデ（place は空文字なら先読み用）
+    "coordinate": PromptTemplate(
+        "gemini-2.5-flash",
+        "条件に合う真似しやすいコーデを1つ提案してください。\n"
+        "性別:{gender} 年齢:{age} 系統:{category} 色:{color} 季節:{season} 予算:{budget}{place}",
+        600, 0.7, None
+    ),
+    # line_function-try: 先読みしたコーデ案を行き先に合わせて手直し
+    "refine": PromptTemplate(
+        "gemini-2.5-flash",
+        "次のコーデ案を行く場所「{place}」に合わせて必要な部分だけ手直しし、完成版だけを出力してください。\n"
+        "{draft}",
+        600, 0.4, None
+    ),
+    # line_function-try: 画像の服に似合うコーデと検索キーワード
+    "image_coordinate": PromptTemplate(
+        "gemini-2.5-flash",
+        "画像の服に似合うコーデを1つ、トップス・ボトムス・靴を具体的に提案してください。\n"
+        "画像ラベル:{labels}\n{colors}\n"
+        "最後の行には次の形式のJSONだけを書いてください（```は付けない）。\n"
+        '{{"tops": "白シャツ メンズ", "bottoms": "黒 スラックス メンズ", "shoes": "ローファー メンズ"}}',
+        700, 0.6, None
+    ),
+    # line_function-try: 複数枚まとめて送られた服を組み合わせたコーデ（画像は1回で全部渡す）
+    "image_set_coordinate": PromptTemplate(
+        "gemini-2.5-flash",
+        "{count}枚の画像はどれも手持ちの服です。これらを組み合わせたコーデを1つ、"
+        "足りないアイテムも含めてトップス・ボトムス・靴を具体的に提案してください。\n"
+        "画像ラベル:{labels}\n{colors}\n"
+        "最後の行には次の形式のJSONだけを書いてください（```は付けない）。\n"
+        '{{"tops": "白シャツ メンズ", "bottoms": "黒 スラックス メンズ", "shoes": "ローファー メンズ"}}',
+        800, 0.6, None
+    ),
+    # line_function-main: 写真の服を主役にしたコーデ
+    "image_styling": PromptTemplate(
+        "gemini-2.0-flash",
+        "写真の服を主役に、条件に合うコーデを2〜3パターン提案してください。"
+        "各パターンはタイトル・アイテムの組み合わせ・着こなしのポイントを簡潔に。"
+        "最後に「このコーデに合うアイテムを探す」と添えてください。\n"
+        "天気:{weather} 好み:{style}",
+        800, 0.8, None
+    ),
+    # line_function2: 服の種類の解析
+    "clothing_analysis": PromptTemplate(
+        "gemini-2.0-flash",
+        "画像の服の type（種類）, color, pattern をJSONで返してください。",
+        100, 0.1, "application/json"
+    ),
+    # line_function2: 複数枚まとめて送られた服の解析（画像の順に配列で返す）
+    "clothing_set_analysis": PromptTemplate(
+        "gemini-2.0-flash",
+        "{count}枚の画像それぞれの服の type（種類）, color, pattern を、画像の順にJSONの配列で返してください。",
+        400, 0.1, "application/json"
+    ),
+    # line_function2 / recommendation_table: アイテム×価格帯のおすすめ
+    "final_recommendation": PromptTemplate(
+        "gemini-2.0-flash",
+        "選んだ服:{item} 価格帯:{price}。おすすめの服と購入サイトを"
+        "JSON（item_name, price, site_url）で返してください。",
+        200, 0.2, "application/json"
+    ),
+}
+
+# テンプレートの確認用の値（python prompts.py）
+SAMPLE_VALUES = {
+    "coordinate": dict(gender="男性", age="20代", category="カジュアル系", color="明るめな色",
+                       season="春", budget="10000円以内", place=" 行く場所:関東・都市部（太平洋側の気候）"),
+    "refine": dict(place="関東・都市部（太平洋側の気候）", draft="白シャツに黒スラックス、ローファーを合わせたコーデ。"),
+    "image_coordinate": dict(labels="Clothing, Shirt", colors="主な色: 紺(48%)、白(33%)\n全体のトーン: 暗めな色"),
+    "image_set_coordinate": dict(count=3, labels="Clothing, Shirt, Pants",
+                                 colors="画像1 主な色: 紺(48%)、白(33%)\n画像2 主な色: ベージュ(61%)"),
+    "image_styling": dict(weather="晴れ、気温25度", style="指定なし"),
+    "clothing_analysis": dict(),
+    "clothing_set_analysis": dict(count=3),
+    "final_recommendation": dict(item="デニムパンツ", price="3000~5000円"),
+}
+
+
+def render(name, **values):
+    return TEMPLATES[name].text.format(**values)
+
+
+# ================================
+# モデル（テンプレートごとに1回だけ作る）
+# ================================
+_models = {}
+_lock = threading.Lock()
+
+
+def _generation_config(template, model_name):
+    max_tokens = template.max_output_tokens
+    if model_name.startswith("gemini-2.5"):
+        max_tokens += THINKING_HEADROOM
+    config = {"max_output_tokens": max_tokens, "temperature": template.temperature}
+    if template.response_mime_type:
+        config["response_mime_type"] = template.response_mime_type
+    return config
+
+
+def get_model(name, model_name=None):
+    template = TEMPLATES[name]
+    model_name = model_name or template.model_name
+    key = (name, model_name)
+    with _lock:
+        if key not in _models:
+            # モデルの生成は通信しないのでロック内でよい
+            _models[key] = genai.GenerativeModel(
+                model_name, system_instruction=PERSONA,
+                generation_config=_generation_config(template, model_name)
+            )
+        return _models[key]
+
+
+# ================================
+# 呼び出しと計測
+# ================================
+_stats = {}
+
+
+class TruncatedResponseError(ValueError):
+    """
+    出力上限まで思考などに使い切り、本文が1文字も返らなかった。
+    """
+
+
+def _hit_max_tokens(response):
+    candidates = getattr(response, "candidates", None) or []
+    return bool(candidates) and getattr(candidates[0].finish_reason, "name", None) == "MAX_TOKENS"
+
+
+def _has_text(response):
+    candidates = getattr(response, "candidates", None) or []
+    return bool(candidates) and any(
+        getattr(part, "text", "") for part in candidates[0].content.parts
+    )
+
+
+def _record(name, response, elapsed_ms):
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    with _lock:
+        stat = _stats.setdefault(name, {"calls": 0, "prompt_tokens": 0, "output_tokens": 0, "ms": 0.0})
+        stat["calls"] += 1
+        stat["prompt_tokens"] += prompt_tokens
+        stat["output_tokens"] += output_tokens
+        stat["ms"] += elapsed_ms
+    print(f"gemini {name}: in={prompt_tokens} out={output_tokens} {elapsed_ms:.0f}ms")
+
+
+def call(name, contents, model_name=None):
+    """
+    組み立て済みの contents でテンプレートの設定のまま呼び出す。
+    """
+    model = get_model(name, model_name)
+    start = time.perf_counter()
+    response = model.generate_content(contents)
+    _record(name, response, (time.perf_counter() - start) * 1000)
+
+    if _hit_max_tokens(response):
+        # 思考に上限を使われて本文が途中で切れた・空になった
+        config = _generation_config(TEMPLATES[name], model_name or TEMPLATES[name].model_name)
+        limit = config["max_output_tokens"] * MAX_TOKENS_RETRY_FACTOR
+        print(f"gemini {name}: MAX_TOKENS, retry with max_output_tokens={limit}")
+        start = time.perf_counter()
+        retry = model.generate_content(contents, generation_config={"max_output_tokens": limit})
+        _record(name, retry, (time.perf_counter() - start) * 1000)
+        # 呼び直しも本文が無ければ、途中まででも本文のある方を使う
+        if _has_text(retry) or not _has_text(response):
+            response = retry
+        if not _has_text(response):
+            raise TruncatedResponseError(f"gemini {name}: no text within {limit} output tokens")
+    return response
+
+
+def generate(name, *parts, **values):
+    """
+    テンプレートに values を埋めて呼び出す。parts は画像など追加の入力。
+    """
+    prompt = render(name, **values)
+    return call(name, [prompt, *parts] if parts else prompt)
+
+
+def report():
+    """
+    テンプレートごとの呼び出し回数・平均トークン数・平均所要時間。
+    """
+    with _lock:
+        return {
+            name: {
+                "calls": s["calls"],
+                "avg_prompt_tokens": round(s["prompt_tokens"] / s["calls"], 1),
+                "avg_output_tokens": round(s["output_tokens"] / s["calls"], 1),
+                "avg_ms": round(s["ms"] / s["calls"], 1),
+            }
+            for name, s in _stats.items()
+        }
+
+
+def main():
+    """
+    各テンプレートの文字数と（APIキーがあれば）入力トークン数を表示する。
+    """
+    api_key = os.environ.get('GOOGLE_API_KEY')
+    if api_key:
+        genai.configure(api_key=api_key)
+    for name, template in TEMPLATES.items():
+        prompt = render(name, **SAMPLE_VALUES[name])
+        line = f"{name:<22} chars={len(prompt):4d} max_out={template.max_output_tokens:4d} temp={template.temperature}"
+        if api_key:
+            tokens = get_model(name).count_tokens(prompt).total_tokens
+            line += f" input_tokens={tokens}"
+        print(line)
+    # このプロセスで呼び出した分の集計（呼び出しが無ければ空）
+    for name, stat in report().items():
+        print(f"{name:<22} {stat}")
+
+
+if __name__ == "__main__":
+    main()
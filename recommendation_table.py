@@ -0,0 +1,222 @@
+# ================================
+# おすすめ結果の事前計算テーブル
+# ================================
+"""
+line_function2 のウィザードで選べるのは
+「アイテム（3種類）× 価格帯（4種類）」の12通りだけなので、
+全組み合わせの回答を事前に生成してバージョン付きのテーブルに保存し、
+実行時は辞書引きだけで返す。
+
+使い方:
+    python recommendation_table.py --out recommendations.json
+    python recommendation_table.py --out s3://bucket/recommendations.json --workers 4
+    python recommendation_table.py --out recommendations.json --stub   # Geminiを呼ばない
+"""
+import os
+import re
+import json
+import time
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import prompts
+
+# ================================
+# ウィザードの選択肢
+# ================================
+RECOMMENDED_ITEMS = ["デニムパンツ", "カーゴパンツ", "スカート"]
+
+PRICE_OPTIONS = [
+    "1000~3000円",
+    "3000~5000円",
+    "5000~10000円",
+    "10000円以上"
+]
+
+# テーブル形式を変えたら上げる
+TABLE_SCHEMA = 1
+
+
+def table_key(selected_item, price_range):
+    return f"{selected_item}|{price_range}"
+
+
+def build_recommendation_prompt(selected_item, price_range):
+    return prompts.render("final_recommendation", item=selected_item, price=price_range)
+
+
+def parse_recommendation(text):
+    """
+    Gemini の出力から JSON 部分だけを取り出す。
+    """
+    json_match = re.search(r'\{[\s\S]*\}', text)
+    if not json_match:
+        raise ValueError(f"JSONが見つかりません: {text[:100]}")
+    return json.loads(json_match.group())
+
+
+# ================================
+# モデルクライアント（差し替え可能）
+# ================================
+class GeminiRecommendationClient:
+    """
+    プロンプトを受け取り、おすすめの dict を返す呼び出し可能オブジェクト。
+    テストやオフライン実行では同じ形の関数（stub_client など）に差し替える。
+    """
+
+    def __init__(self, model_name=None):
+        # 生成設定（出力長・温度・JSON出力）は prompts.py の final_recommendation
+        self.model_name = model_name
+
+    def __call__(self, prompt):
+        response = prompts.call("final_recommendation", prompt, self.model_name)
+        return parse_recommendation(response.text)
+
+
+def stub_client(prompt):
+    """
+    Gemini を呼ばずに固定の形の結果を返す（動作確認用）。
+    """
+    return {
+        "item_name": prompt[:40],
+        "price": "-",
+        "site_url": "https://www.amazon.co.jp/"
+    }
+
+
+# ================================
+# 事前計算
+# ================================
+def build_table(client, max_workers=4, version=None):
+    """
+    全組み合わせの回答を並列数を制限して生成する。
+    失敗した組み合わせはテーブルに含めない（実行時はライブ生成にフォールバック）。
+    """
+    combos = list(itertools.product(RECOMMENDED_ITEMS, PRICE_OPTIONS))
+
+    def generate(combo):
+        try:
+            return combo, client(build_recommendation_prompt(*combo))
+        except Exception as e:
+            print(f"precompute error {combo}: {e}")
+            return combo, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(generate, combos))
+
+    entries = {
+        table_key(*combo): recommendation
+        for combo, recommendation in results
+        if recommendation is not None
+    }
+    return {
+        "schema": TABLE_SCHEMA,
+        "version": version if version is not None else int(time.time()),
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "entries": entries
+    }
+
+
+def _split_s3(location):
+    bucket, _, key = location[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def write_table(data, location):
+    body = json.dumps(data, ensure_ascii=False, indent=2)
+    if location.startswith("s3://"):
+        import boto3
+        bucket, key = _split_s3(location)
+        boto3.client("s3").put_object(
+            Bucket=bucket, Key=key, Body=body.encode("utf-8"),
+            ContentType="application/json"
+        )
+        return
+    tmp = location + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(body)
+    os.replace(tmp, location)
+
+
+def read_table(location):
+    if location.startswith("s3://"):
+        import boto3
+        bucket, key = _split_s3(location)
+        body = boto3.client("s3").get_object(Bucket=bucket, Key=key)["Body"].read()
+        return json.loads(body)
+    with open(location, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ================================
+# 実行時のルックアップ
+# ================================
+class RecommendationTable:
+    """
+    事前計算テーブルを保持し、辞書引きで回答を返す。
+    start_refresh() で新しいバージョンをバックグラウンドで取り込む。
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.version = None
+        self.entries = {}
+        self.reload()
+
+    def reload(self):
+        try:
+            data = read_table(self.location)
+        except Exception as e:
+            print(f"recommendation table load error: {e}")
+            return False
+        if data.get("schema") != TABLE_SCHEMA:
+            print(f"recommendation table schema mismatch: {data.get('schema')}")
+            return False
+        if self.version is not None and data.get("version", 0) <= self.version:
+            return False
+        # 参照の差し替えだけなのでロック不要
+        self.entries = data.get("entries", {})
+        self.version = data.get("version")
+        return True
+
+    def lookup(self, selected_item, price_range):
+        return self.entries.get(table_key(selected_item, price_range))
+
+    def start_refresh(self, interval_seconds):
+        if interval_seconds <= 0:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval_seconds)
+                self.reload()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="おすすめ結果の事前計算")
+    parser.add_argument("--out", required=True, help="出力先（ファイルパス または s3://bucket/key）")
+    parser.add_argument("--workers", type=int, default=4, help="Geminiの同時呼び出し数")
+    parser.add_argument("--version", type=int, default=None, help="テーブルのバージョン（省略時は現在時刻）")
+    parser.add_argument("--model", default=None, help="省略時は prompts.py の設定")
+    parser.add_argument("--stub", action="store_true", help="Geminiを呼ばずにスタブで生成")
+    args = parser.parse_args(argv)
+
+    if args.stub:
+        client = stub_client
+    else:
+        import google.generativeai as genai
+        genai.configure(api_key=os.environ['GOOGLE_API_KEY'])
+        client = GeminiRecommendationClient(args.model)
+
+    data = build_table(client, max_workers=args.workers, version=args.version)
+    write_table(data, args.out)
+    total = len(RECOMMENDED_ITEMS) * len(PRICE_OPTIONS)
+    print(f"version {data['version']}: {len(data['entries'])}/{total} entries -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
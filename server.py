@@ -0,0 +1,230 @@
+# ================================
+# 常駐型 asyncio サーバー
+# ================================
+"""
+lambda_handler と同じハンドラーを、常駐する asyncio HTTP サーバーで動かす。
+
+Lambda では1インスタンスが1リクエストずつ処理し、時間のほとんどを
+Gemini / Rekognition / LINE の I/O 待ちで過ごしている。
+ここではイベントループが HTTP の受付だけを行い、ブロッキングする
+ハンドラー（boto3 / LINE SDK / Gemini の同期呼び出し）は共有スレッドプールへ逃がす。
+モジュールは1回だけ import するので、クライアントやキャッシュはプロセス全体で共有される。
+
+使い方:
+    python server.py line_function-try --port 8080
+    python server.py --bench             # Lambda方式との比較（通信は待ち時間だけの代役）
+"""
+import os
+import hmac
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import argparse
+import importlib
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+# 同時に処理するイベント数（I/O待ちが中心なので大きめ）
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '256'))
+
+
+class WebhookServer:
+
+    def __init__(self, module, workers=SERVER_WORKERS):
+        self.module = module
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook")
+
+    async def callback(self, request):
+        body = await request.text()
+        event = {
+            'body': body,
+            'headers': {'x-line-signature': request.headers.get('X-Line-Signature', '')}
+        }
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(
+                self.executor, self.module.lambda_handler, event, None
+            )
+        except Exception as e:
+            print(f"webhook error: {e}")
+            return web.Response(status=400, text='NG')
+        return web.Response(
+            status=result.get('statusCode', 200), text=result.get('body', 'OK')
+        )
+
+    async def health(self, request):
+        return web.Response(text='OK')
+
+    async def _shutdown(self, app):
+        self.executor.shutdown(wait=True)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/callback', self.callback)
+        app.router.add_get('/health', self.health)
+        app.on_cleanup.append(self._shutdown)
+        return app
+
+
+# ================================
+# ベンチマーク
+# ================================
+# 外部APIの待ち時間（秒）。実際の lambda_handler を、通信部分だけ差し替えて動かす
+BENCH_LATENCY = {"dynamodb": 0.01, "gemini": 0.5, "line": 0.05}
+
+BENCH_ANSWERS = {
+    "gender": "女性", "category": "ガーリー", "age": "20代", "color": "モノトーン",
+    "season": "冬", "budget": "特に気にしない",
+}
+
+
+class _BenchTable:
+    """
+    DynamoDB の Table の代わり。待ち時間だけ再現し、全員ウィザード回答済みの項目を返す。
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_item(self, Key, **kwargs):
+        import wizard_state
+        time.sleep(self.latency)
+        state = {"v": wizard_state.SCHEMA_VERSION, "st": len(wizard_state.FIELDS)}
+        state.update(dict(wizard_state.encode_answer(k, v) for k, v in BENCH_ANSWERS.items()))
+        return {"Item": {"id": Key["id"], wizard_state.STATE_ATTR: state}}
+
+    def update_item(self, **kwargs):
+        time.sleep(self.latency)
+        return {}
+
+    def put_item(self, **kwargs):
+        time.sleep(self.latency)
+        return {}
+
+
+class _BenchModel:
+    """
+    Gemini の GenerativeModel の代わり。待ち時間のあと決まった文章を返す。
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.latency)
+        text = "白のニットにグレーのスカート、黒のショートブーツを合わせたコーデです。"
+        return SimpleNamespace(
+            text=text,
+            candidates=[SimpleNamespace(
+                finish_reason=SimpleNamespace(name="STOP"),
+                content=SimpleNamespace(parts=[SimpleNamespace(text=text)])
+            )],
+            usage_metadata=SimpleNamespace(prompt_token_count=0, candidates_token_count=0)
+        )
+
+
+def _load_bench_module(name, latency):
+    """
+    ハンドラーのモジュールを import し、LINE / Gemini / DynamoDB の通信を待ち時間だけの代役に替える。
+    """
+    for key, value in [('CHANNEL_SECRET', 'benchmark'), ('CHANNEL_ACCESS_TOKEN', 'benchmark'),
+                       ('S3_BUCKET', 'benchmark'), ('AWS_DEFAULT_REGION', 'ap-northeast-1')]:
+        os.environ.setdefault(key, value)
+    os.environ.setdefault('SERVER_WORKERS', str(SERVER_WORKERS))
+    module = importlib.import_module(name)
+
+    def line_post(url, headers=None, data=None, timeout=None):
+        time.sleep(latency["line"])
+        return SimpleNamespace(status_code=200, headers={}, json={})
+
+    import prompts
+    module.line_bot_api.http_client.post = line_post
+    module.table = _BenchTable(latency["dynamodb"])
+    model = _BenchModel(latency["gemini"])
+    prompts.get_model = lambda name, model_name=None: model
+    return module
+
+
+def _bench_event(module, i):
+    """
+    位置情報メッセージ1件の Webhook（保存 → 読み込み → Gemini → 返信）。
+    """
+    body = json.dumps({"destination": "U0", "events": [{
+        "type": "message", "mode": "active", "timestamp": 1700000000000 + i,
+        "webhookEventId": f"EV{i}", "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"token{i}", "source": {"type": "user", "userId": f"U{i % 50}"},
+        "message": {"type": "location", "id": str(i), "address": "日本、東京都渋谷区渋谷２丁目",
+                    "latitude": 35.658, "longitude": 139.701},
+    }]})
+    signature = base64.b64encode(
+        hmac.new(module.handler.channel_secret, body.encode("utf-8"), hashlib.sha256).digest()
+    ).decode()
+    return body, signature
+
+
+async def _bench_server(module, requests_count, port):
+    import aiohttp
+    server = WebhookServer(module)
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async def post(i):
+                body, signature = _bench_event(module, i)
+                async with session.post(f'http://127.0.0.1:{port}/callback', data=body.encode("utf-8"),
+                                        headers={'X-Line-Signature': signature}) as res:
+                    await res.read()
+                    assert res.status == 200, res.status
+
+            start = time.perf_counter()
+            await asyncio.gather(*(post(i) for i in range(requests_count)))
+            return time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+
+
+def benchmark(name="line_function-try", requests_count=200, port=18080, latency=BENCH_LATENCY):
+    module = _load_bench_module(name, latency)
+
+    # Lambda方式: 1インスタンスが1リクエストずつ処理（数件の平均から推定）
+    sample = 5
+    start = time.perf_counter()
+    for i in range(sample):
+        body, signature = _bench_event(module, i)
+        module.lambda_handler({'body': body, 'headers': {'x-line-signature': signature}}, None)
+    lambda_elapsed = (time.perf_counter() - start) / sample * requests_count
+
+    server_elapsed = asyncio.run(_bench_server(module, requests_count, port))
+
+    waits = ", ".join(f"{k} {v * 1000:.0f} ms" for k, v in latency.items())
+    print(f"{name}: {requests_count} location messages ({waits})")
+    print(f"lambda (1 instance): {lambda_elapsed:.1f} s  {requests_count / lambda_elapsed:.1f} req/s (推定)")
+    print(f"server (1 process) : {server_elapsed:.1f} s  {requests_count / server_elapsed:.1f} req/s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Webhookを常駐サーバーで処理する")
+    parser.add_argument("module", nargs="?", default="line_function-try", help="lambda_handler を持つモジュール名")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get('PORT', '8080')))
+    parser.add_argument("--bench", action="store_true", help="Lambda方式との比較ベンチマーク")
+    args = parser.parse_args(argv)
+
+    if args.bench:
+        benchmark(args.module)
+        return
+
+    # ハンドラー側の HTTP 接続プールをワーカー数に合わせる（import 前に渡す）
+    os.environ.setdefault('SERVER_WORKERS', str(SERVER_WORKERS))
+    # ファイル名にハイフンを含むモジュールもそのまま import できる
+    module = importlib.import_module(args.module)
+    web.run_app(WebhookServer(module).make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
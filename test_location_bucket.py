@@ -0,0 +1,37 @@
+import location_bucket
+
+
+def test_japanese_address_in_tokyo_wards():
+    bucket = location_bucket.classify(35.658, 139.701, "日本、東京都渋谷区渋谷２丁目")
+    assert bucket.region == "関東"
+    assert bucket.venue == location_bucket.URBAN
+
+
+def test_english_address_uses_nearest_point():
+    bucket = location_bucket.classify(35.658, 139.701, "Shibuya City, Tokyo 150-0002, Japan")
+    assert bucket.region == "関東"
+    assert bucket.venue == location_bucket.URBAN
+
+
+def test_no_address():
+    bucket = location_bucket.classify(43.062, 141.354)
+    assert bucket.region == "北海道"
+    assert location_bucket.classify() is location_bucket.UNKNOWN
+
+
+def test_overseas_point():
+    assert location_bucket.classify(40.713, -74.006, "New York, NY, USA") is location_bucket.OVERSEAS
+
+
+def test_outlying_islands_without_prefecture_name():
+    assert location_bucket.classify(24.34, 124.16, "Ishigaki, Okinawa, Japan").region == "九州・沖縄"
+    assert location_bucket.classify(43.33, 145.58, "Nemuro, Hokkaido, Japan").region == "北海道"
+
+
+def test_korea_is_overseas():
+    assert location_bucket.classify(35.18, 129.07, "Busan, South Korea") is location_bucket.OVERSEAS
+
+
+def test_boundary_contains_every_reference_point():
+    for row in location_bucket.PREFECTURES + location_bucket.CITIES:
+        assert location_bucket.in_japan(row[-2], row[-1]), row[0]
@@ -0,0 +1,122 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import wizard_state
+
+KEY = {"id": "U1"}
+EXPIRES_AT = 2000000000
+
+
+class FakeTable:
+    """
+    save_answer が使う update_item（SET / REMOVE と attribute_exists の条件）だけを持つテーブル。
+    interrupt を渡すと、interrupt_at 回目の書き込みの直前に1回だけ呼ぶ（別の呼び出しの割り込み）。
+    """
+
+    def __init__(self, item=None, interrupt=None, interrupt_at=0):
+        self.item = dict(item or {})
+        self.interrupt = interrupt
+        self.interrupt_at = interrupt_at
+        self.calls = []
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues, ConditionExpression=None, ReturnValues=None):
+        self.calls.append(UpdateExpression)
+        if self.interrupt and len(self.calls) == self.interrupt_at:
+            interrupt, self.interrupt = self.interrupt, None
+            interrupt(self)
+        names, values = ExpressionAttributeNames, ExpressionAttributeValues
+        if ConditionExpression:
+            exists = names["#w"] in self.item
+            if exists != ConditionExpression.startswith("attribute_exists"):
+                raise ClientError(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem"
+                )
+        set_part, _, remove_part = UpdateExpression[len("SET "):].partition(" REMOVE ")
+        for assignment in set_part.split(", "):
+            path, value = assignment.split(" = ")
+            attrs = [names.get(p, p) for p in path.split(".")]
+            target = self.item
+            for attr in attrs[:-1]:
+                target = target[attr]
+            target[attrs[-1]] = values[value]
+        for name in filter(None, remove_part.split(", ")):
+            self.item.pop(names[name], None)
+
+
+def test_round_trip():
+    table = FakeTable({"id": "U1"})
+    answers = {
+        "gender": "女性", "category": "ガーリー", "age": "20代", "color": "モノトーン",
+        "season": "冬", "budget": "特に気にしない", "area": "関東・都市部（太平洋側の気候）",
+    }
+    for name, value in answers.items():
+        wizard_state.save_answer(table, KEY, name, value, EXPIRES_AT)
+
+    assert table.item["w"]["st"] == len(wizard_state.KEYS)
+    assert wizard_state.session_from_item(table.item, now=0) == dict({"id": "U1"}, **answers)
+
+
+def test_each_answer_is_one_write_without_read():
+    table = FakeTable({"id": "U1"})
+    wizard_state.save_answer(table, KEY, "gender", "男性", EXPIRES_AT)
+    wizard_state.save_answer(table, KEY, "category", "アメカジ", EXPIRES_AT)
+    wizard_state.save_answer(table, KEY, "age", "30代", EXPIRES_AT)
+    # 最初の1回だけ "w" の作成で2回、その後は1回ずつ
+    assert len(table.calls) == 4
+    assert not hasattr(table, "get_item")
+
+
+def test_legacy_attributes_are_read_and_removed_when_answered_again():
+    table = FakeTable({
+        "id": "U1", "gender": "男性", "category": "綺麗系", "address": "大阪府大阪市",
+        "draft": {"text": "..."},
+    })
+    assert wizard_state.session_from_item(table.item, now=0) == {
+        "id": "U1", "gender": "男性", "category": "綺麗系", "area": "大阪府大阪市",
+        "draft": {"text": "..."},
+    }
+
+    wizard_state.save_answer(table, KEY, "category", "フォーマル", EXPIRES_AT)
+    wizard_state.save_answer(table, KEY, "area", "近畿・都市部", EXPIRES_AT)
+
+    assert "category" not in table.item and "address" not in table.item
+    assert table.item["gender"] == "男性"
+    session = wizard_state.session_from_item(table.item, now=0)
+    assert session["gender"] == "男性"
+    assert session["category"] == "フォーマル"
+    assert session["area"] == "近畿・都市部"
+    assert session["draft"] == {"text": "..."}
+
+
+def test_legacy_packed_string_is_read():
+    # v1 の "s"（性別・カテゴリー・年齢の番号と場所）
+    item = {"id": "U1", "s": "1:3:021---|北海道"}
+    assert wizard_state.session_from_item(item, now=0) == {
+        "id": "U1", "gender": "男性", "category": "フォーマル", "age": "20代", "area": "北海道",
+    }
+
+
+def test_expired_item_is_empty():
+    table = FakeTable({"id": "U1"})
+    wizard_state.save_answer(table, KEY, "gender", "女性", EXPIRES_AT)
+    assert wizard_state.session_from_item(table.item, now=EXPIRES_AT + 1) == {}
+    assert wizard_state.session_from_item(table.item, now=EXPIRES_AT - 1)["gender"] == "女性"
+
+
+def test_concurrent_first_answers_are_both_kept():
+    # "w" が無いので作ろうとした直前に、別の呼び出しが先に "w" を作った
+    def other_save(table):
+        wizard_state.save_answer(table, KEY, "gender", "女性", EXPIRES_AT)
+
+    table = FakeTable({"id": "U1"}, interrupt=other_save, interrupt_at=2)
+    wizard_state.save_answer(table, KEY, "age", "40代", EXPIRES_AT)
+
+    session = wizard_state.session_from_item(table.item, now=0)
+    assert session["gender"] == "女性"
+    assert session["age"] == "40代"
+
+
+def test_value_outside_options():
+    with pytest.raises(ValueError):
+        wizard_state.save_answer(FakeTable(), KEY, "season", "梅雨", EXPIRES_AT)
@@ -0,0 +1,249 @@
+# ================================
+# ウィザードの回答の圧縮表現
+# ================================
+"""
+line_function-try のウィザードの回答（性別・カテゴリー・年齢・色・季節・予算・場所）を
+1つの小さな Map 属性 "w" にまとめて DynamoDB に保存する。
+
+    "w": {"v": 2, "st": 6, "g": 1, "c": 6, "a": 1, "k": 3, "n": 2, "b": 4}
+          │       │        └ 回答ごとに短いキーと選択肢の番号（場所 "ar" だけは文字列）
+          │       └ ステップ（最後に答えた項目の番号）
+          └ 形式のバージョン
+
+- 回答の保存は "w" の中の1要素だけを SET するので、読み込み不要で1回の書き込みで済む
+  （ほかの回答を上書きしないので、同時に保存しても回答は失われない）
+- "w" が無い場合（最初の回答・旧形式の項目）は、その回答だけで "w" を作る
+- 旧形式（1項目1属性の日本語の値、v1 の文字列 "s"）は読み込み時に補う。
+  1項目1属性の値はその項目を答え直した時に削除する（"s" は TTL で消える）
+
+選択肢は番号で保存するため、リストの途中への追加・並べ替えはしないこと
+（追加は末尾に。変える場合は SCHEMA_VERSION を上げる）。
+
+旧形式との項目サイズの比較:
+    python wizard_state.py
+"""
+import time
+
+from botocore.exceptions import ClientError
+
+SCHEMA_VERSION = 2
+
+# ================================
+# 選択肢（クイックリプライの並び順）
+# ================================
+GENDERS = ["男性", "女性"]
+
+CATEGORIES_MEN = ["カジュアル系", "アメカジ", "綺麗系", "フォーマル", "スポーツ", "ビンテージ", "デザイナーズ", "ストリート", "地雷系"]
+CATEGORIES_WOMEN = ["カジュアル系", "綺麗系", "フォーマル", "スポーツ", "エレガンス", "ガーリー", "デザイナーズ", "ストリート", "地雷系"]
+# 保存用の番号はこの並び（男女の和集合）
+CATEGORIES = ["カジュアル系", "綺麗系", "フォーマル", "スポーツ", "ストリート", "エレガンス", "ガーリー", "アメカジ", "ビンテージ", "デザイナーズ", "地雷系"]
+
+AGES = ["10代", "20代", "30代", "40代", "50代", "60代以上"]
+
+COLORS = ["明るめな色", "暗めな色", "派手目の色", "落ち着いた色", "モノトーン"]
+
+SEASONS = ["春", "夏", "秋", "冬"]
+
+BUDGETS = ["10000円以内", "10000円〜20000円", "20000円〜30000円", "30000円以上", "特に気にしない"]
+
+# ウィザードの順番（名前, "w" の中のキー, 選択肢）
+FIELDS = [
+    ("gender", "g", GENDERS),
+    ("category", "c", CATEGORIES),
+    ("age", "a", AGES),
+    ("color", "k", COLORS),
+    ("season", "n", SEASONS),
+    ("budget", "b", BUDGETS),
+]
+AREA = "area"
+AREA_CODE = "ar"
+KEYS = tuple(name for name, _, _ in FIELDS) + (AREA,)
+
+STATE_ATTR = "w"
+TTL_ATTR = "expires_at"
+# 旧形式の属性（読み込み時に補い、答え直した時に削除する）
+LEGACY_PACKED_ATTR = "s"
+LEGACY_ATTRS = KEYS + ("address", LEGACY_PACKED_ATTR)
+
+_CODES = {name: (code, options) for name, code, options in FIELDS}
+_CODES[AREA] = (AREA_CODE, None)
+
+
+def encode_answer(name, value):
+    """
+    回答1つを ("w" の中のキー, 保存する値) にする。
+    選択肢にない値は ValueError（番号にできないため）。
+    """
+    code, options = _CODES[name]
+    if options is None:
+        return code, str(value)
+    if value not in options:
+        raise ValueError(f"{name} に選択肢にない値: {value}")
+    return code, options.index(value)
+
+
+def decode_state(state):
+    """
+    "w" の Map を回答の dict に戻す。未回答・壊れた項目はキーを含めない。
+    """
+    answers = {}
+    if not isinstance(state, dict) or int(state.get("v", 0)) != SCHEMA_VERSION:
+        return answers
+    for name, (code, options) in _CODES.items():
+        if code not in state:
+            continue
+        if options is None:
+            answers[name] = state[code]
+            continue
+        index = int(state[code])
+        if 0 <= index < len(options):
+            answers[name] = options[index]
+    return answers
+
+
+def _decode_packed(packed):
+    """
+    v1 の文字列 "1:6:0213-3|場所" を回答の dict に戻す（読み込み専用）。
+    """
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    try:
+        version, _, rest = packed.split(":", 2)
+        codes, area = rest.split("|", 1)
+        if int(version) != 1 or len(codes) != len(FIELDS):
+            return {}
+        answers = {
+            name: options[digits.index(c)]
+            for (name, _, options), c in zip(FIELDS, codes) if c != "-"
+        }
+        if area:
+            answers[AREA] = area
+        return answers
+    except (AttributeError, ValueError, IndexError):
+        return {}
+
+
+def _legacy_answers(item):
+    answers = {
+        name: item[name] for name, _, options in FIELDS
+        if item.get(name) in options
+    }
+    area = item.get(AREA, item.get("address"))
+    if area:
+        answers[AREA] = area
+    answers.update(_decode_packed(item.get(LEGACY_PACKED_ATTR)))
+    return answers
+
+
+def session_from_item(item, now=None):
+    """
+    DynamoDB の項目をセッションの dict（gender, category, ... area と、その他の属性）にする。
+    - 期限切れ（TTL の削除待ち）なら空の dict
+    - 旧形式の回答は "w" に無い項目だけ補う
+    """
+    if not item:
+        return {}
+    expires_at = item.get(TTL_ATTR)
+    if expires_at is not None and int(expires_at) < (time.time() if now is None else now):
+        return {}
+    answers = _legacy_answers(item)
+    answers.update(decode_state(item.get(STATE_ATTR)))
+    session = {
+        k: v for k, v in item.items()
+        if k not in LEGACY_ATTRS and k not in (STATE_ATTR, TTL_ATTR)
+    }
+    session.update(answers)
+    return session
+
+
+# ================================
+# 保存
+# ================================
+def _is_conditional_failure(error):
+    return error.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException"
+
+
+def save_answer(table, key, name, value, expires_at):
+    """
+    回答1つを保存する。読み込みはしない。
+    - 通常は "w" の中の1要素とステップだけを SET（1回の書き込み）
+    - "w" がまだ無ければ、この回答だけで作る（作られていたら1回目の方法でやり直す）
+    同じ項目の旧形式の属性があれば一緒に削除する。
+    """
+    code, stored = encode_answer(name, value)
+    step = KEYS.index(name) + 1
+    legacy = [name, "address"] if name == AREA else [name]
+    names = {"#w": STATE_ATTR, "#c": code, "#e": TTL_ATTR}
+    names.update({f"#l{i}": attr for i, attr in enumerate(legacy)})
+    remove = " REMOVE " + ", ".join(f"#l{i}" for i in range(len(legacy)))
+
+    for _ in range(2):
+        try:
+            table.update_item(
+                Key=key,
+                UpdateExpression="SET #w.#c = :v, #w.st = :st, #e = :e" + remove,
+                ConditionExpression="attribute_exists(#w)",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={":v": stored, ":st": step, ":e": expires_at},
+                ReturnValues="NONE"
+            )
+            return
+        except ClientError as e:
+            if not _is_conditional_failure(e):
+                raise
+        try:
+            table.update_item(
+                Key=key,
+                UpdateExpression="SET #w = :w, #e = :e" + remove,
+                ConditionExpression="attribute_not_exists(#w)",
+                ExpressionAttributeNames={k: v for k, v in names.items() if k != "#c"},
+                ExpressionAttributeValues={
+                    ":w": {"v": SCHEMA_VERSION, "st": step, code: stored},
+                    ":e": expires_at,
+                },
+                ReturnValues="NONE"
+            )
+            return
+        except ClientError as e:
+            # 同時に別の保存が "w" を作った: 1回目の方法でやり直す
+            if not _is_conditional_failure(e):
+                raise
+    raise RuntimeError(f"save_answer: {name} を保存できませんでした")
+
+
+# ================================
+# サイズ比較
+# ================================
+def _item_bytes(item):
+    """
+    DynamoDB の項目サイズの概算（属性名・Map のキーと値の UTF-8 バイト数、数値は桁数）。
+    Map は1要素ごとに1バイト、全体で3バイトの追加がある。
+    """
+    size = 0
+    for k, v in item.items():
+        size += len(k.encode("utf-8"))
+        if isinstance(v, dict):
+            size += 3 + sum(len(mk.encode("utf-8")) + 1 + len(str(mv).encode("utf-8")) for mk, mv in v.items())
+        else:
+            size += len(str(v).encode("utf-8"))
+    return size
+
+
+def benchmark():
+    answers = {
+        "gender": "女性", "category": "デザイナーズ", "age": "20代", "color": "落ち着いた色",
+        "season": "秋", "budget": "10000円〜20000円", "area": "関東・都市部（太平洋側の気候）",
+    }
+    user_id = "U" + "0" * 32
+    state = {"v": SCHEMA_VERSION, "st": len(KEYS)}
+    state.update(dict(encode_answer(name, value) for name, value in answers.items()))
+    legacy = dict({"id": user_id}, **answers)
+    packed = {"id": user_id, STATE_ATTR: state, TTL_ATTR: 1767225600}
+    assert session_from_item(packed, now=0) == dict({"id": user_id}, **answers)
+
+    for label, item in [("legacy (1 attribute per answer)", legacy), ("packed map", packed)]:
+        print(f"{label:<32} {_item_bytes(item):4d} bytes, {len(item)} attributes")
+    print("per wizard step: legacy 1 write, packed map 1 write (no read)")
+
+
+if __name__ == "__main__":
+    benchmark()